@@ -30,9 +30,12 @@ This package contains the protocols for
 manipulation of atomic struct objects
 """
 
+import os
 import pwem
+import pyworkflow as pw
 from .bibtex import _bibtexStr
 from pwem.constants import MAXIT
+from .constants import ATOMSTRUCTUTILS_CACHE
 
 __version__ = "3.0.4"
 _references = ['Cock2009']
@@ -41,6 +44,19 @@ _logo = 'tool.png'
 
 class Plugin(pwem.Plugin):
 
+    @classmethod
+    def _defineVariables(cls):
+        pwem.Plugin._defineVariables()
+        # results that can be reused between executions (superposition
+        # matrices, RMSDs...) are stored here
+        cls._defineVar(ATOMSTRUCTUTILS_CACHE,
+                       os.path.join(pw.Config.SCIPION_USER_DATA,
+                                    'cache', 'atomstructutils'))
+
+    @classmethod
+    def getCacheDir(cls):
+        return cls.getVar(ATOMSTRUCTUTILS_CACHE)
+
     @classmethod
     def defineBinaries(cls, env):
         pwem.Plugin.defineBinaries(env)
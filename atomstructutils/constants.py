@@ -24,3 +24,6 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+
+# plugin variables
+ATOMSTRUCTUTILS_CACHE = 'ATOMSTRUCTUTILS_CACHE'
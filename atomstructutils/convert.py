@@ -0,0 +1,495 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *              Marta Martinez (mmmtnez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Low level readers/writers used by the protocols of this plugin.
+They work directly on the files so that large maps and atomic
+structures do not need to be fully loaded in memory.
+"""
+
+import hashlib
+import os
+import re
+import struct
+import numpy as np
+
+MRC_HEADER_SIZE = 1024
+# MRC mode -> numpy data type
+MRC_MODES = {0: np.int8,
+             1: np.int16,
+             2: np.float32,
+             6: np.uint16,
+             12: np.float16}
+MRC_EXTENSIONS = ['.mrc', '.map', '.ccp4', '.mrcs']
+CIF_EXTENSIONS = ['.cif', '.mmcif']
+CIF_UNKNOWN = ['?', '.']
+
+# getChainCount results, {(file, size, modification time): chains}
+_chainCounts = {}
+
+
+def getMrcFileName(fileName):
+    """ Remove the scipion format suffix (file.mrc:mrc) if present"""
+    return fileName.split(':')[0]
+
+
+def readMrcHeader(fileName):
+    """ Read the fields of the MRC header needed to access the data.
+        return a dictionary with the keys
+        nx, ny, nz, mode, nsymbt, byteOrder
+    """
+    with open(getMrcFileName(fileName), 'rb') as f:
+        header = f.read(MRC_HEADER_SIZE)
+    # machine stamp, 0x44 0x41 -> little endian, 0x11 0x11 -> big endian
+    byteOrder = '>' if header[212] == 0x11 else '<'
+    nx, ny, nz, mode = struct.unpack(byteOrder + '4i', header[0:16])
+    mapc, mapr, maps = struct.unpack(byteOrder + '3i', header[64:76])
+    nsymbt, = struct.unpack(byteOrder + 'i', header[92:96])
+    if mode not in MRC_MODES:
+        raise Exception("MRC mode %d is not supported (file %s)"
+                        % (mode, fileName))
+    if (mapc, mapr, maps) != (1, 2, 3):
+        raise Exception("Only MRC files with axis order x, y, z are "
+                        "supported. File %s has %d %d %d"
+                        % (fileName, mapc, mapr, maps))
+    return {'nx': nx, 'ny': ny, 'nz': nz, 'mode': mode,
+            'nsymbt': nsymbt, 'byteOrder': byteOrder}
+
+
+def mapMrcData(fileName, mode='r'):
+    """ Memory map the data of a MRC file.
+        return a numpy.memmap with shape (z, y, x). Voxels are only read
+        from disk when accessed.
+    """
+    header = readMrcHeader(fileName)
+    dtype = np.dtype(MRC_MODES[header['mode']]).newbyteorder(
+        header['byteOrder'])
+    return np.memmap(getMrcFileName(fileName), dtype=dtype, mode=mode,
+                     offset=MRC_HEADER_SIZE + header['nsymbt'],
+                     shape=(header['nz'], header['ny'], header['nx']))
+
+
+def createMrcFile(fileName, shape, sampling, dtype=np.float32):
+    """ Create a MRC file filled with zeros and return its data
+        memory mapped (shape (z, y, x)). Data are written
+        to disk as the memmap is modified so the full volume is never
+        held in memory. Origin should be set afterwards with
+        Ccp4Header.fixFile
+    """
+    nz, ny, nx = shape
+    mode = [key for key, value in MRC_MODES.items()
+            if np.dtype(value) == np.dtype(dtype)][0]
+    header = bytearray(MRC_HEADER_SIZE)
+    struct.pack_into('<4i', header, 0, nx, ny, nz, mode)
+    struct.pack_into('<3i', header, 28, nx, ny, nz)  # mx, my, mz
+    struct.pack_into('<6f', header, 40, nx * sampling, ny * sampling,
+                     nz * sampling, 90., 90., 90.)  # cell
+    struct.pack_into('<3i', header, 64, 1, 2, 3)  # mapc, mapr, maps
+    header[208:212] = b'MAP '
+    header[212:216] = b'\x44\x41\x00\x00'  # little endian
+    dataSize = nx * ny * nz * np.dtype(dtype).itemsize
+    with open(fileName, 'wb') as f:
+        f.write(header)
+        # sparse file, no data is written here
+        f.truncate(MRC_HEADER_SIZE + dataSize)
+    return np.memmap(fileName, dtype=np.dtype(dtype).newbyteorder('<'),
+                     mode='r+', offset=MRC_HEADER_SIZE, shape=shape)
+
+
+def setMrcStatistics(fileName, dmin, dmax, dmean, rms):
+    """ Store min, max, mean and rms in the header of a MRC file"""
+    byteOrder = readMrcHeader(fileName)['byteOrder']
+    with open(getMrcFileName(fileName), 'r+b') as f:
+        f.seek(76)
+        f.write(struct.pack(byteOrder + '3f', dmin, dmax, dmean))
+        f.seek(216)
+        f.write(struct.pack(byteOrder + 'f', rms))
+
+
+def readMrcStatistics(fileName):
+    """ min, max, mean and rms stored in the header of a MRC file"""
+    byteOrder = readMrcHeader(fileName)['byteOrder']
+    with open(getMrcFileName(fileName), 'rb') as f:
+        header = f.read(MRC_HEADER_SIZE)
+    dmin, dmax, dmean = struct.unpack(byteOrder + '3f', header[76:88])
+    rms, = struct.unpack(byteOrder + 'f', header[216:220])
+    return dmin, dmax, dmean, rms
+
+
+def getFileHash(fileName, blockSize=2 ** 20):
+    """ sha256 of the content of a file, it is read in blocks"""
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def isCifFile(fileName):
+    return os.path.splitext(fileName)[1].lower() in CIF_EXTENSIONS
+
+
+def readCAlphas(fileName, start=-1, end=-1):
+    """ Read the alpha carbons of the first model of a PDB or mmCIF file.
+        start, end: first and last residue number (-1 -> no limit)
+        return a dictionary {(chain index, residue number, insertion
+        code): (x, y, z)}. Chains are numbered in order of appearance.
+        The atoms are read in bulk (see readAtoms), so it is much faster
+        than building the full structure
+    """
+    atoms = readAtoms(fileName, records=(b'ATOM', b'HETATM'))
+    # CA is also calcium, told apart by the element (or the residue
+    # name of the ion if the element is missing)
+    element = atoms['element']
+    selected = (atoms['name'] == b'CA') & (
+        (element == b'C') | ((element == b'') & (atoms['resName'] != b'CA')))
+    chains = _getChainIndexes(atoms['chain'][selected])
+    resSeqs = atoms['resSeq'][selected].astype(int)
+    inRange = ((start == -1) | (resSeqs >= start)) & \
+              ((end == -1) | (resSeqs <= end))
+    coords = {}
+    for chain, resSeq, iCode, xyz in zip(
+            chains[inRange].tolist(), resSeqs[inRange].tolist(),
+            atoms['iCode'][selected][inRange].tolist(),
+            atoms['coords'][selected][inRange].tolist()):
+        # keep the first alternate location
+        coords.setdefault((chain, resSeq, iCode.decode()), tuple(xyz))
+    return coords
+
+
+def readCommonCAlphas(referenceFileName, fileNames, start=-1, end=-1):
+    """ Alpha carbons shared by the reference and each one of the
+        atomic structures fileNames. Residues are matched by chain order,
+        residue number and insertion code. The reference is read once.
+        return a list with a pair of arrays (N, 3) (reference, other)
+        per file, N is the number of alpha carbons common to both
+        structures, so each pair does not depend on the other files
+    """
+    reference = readCAlphas(referenceFileName, start, end)
+    pairs = []
+    for fileName in fileNames:
+        coords = readCAlphas(fileName, start, end)
+        common = sorted(set(reference) & set(coords))
+        pairs.append((
+            np.array([reference[key] for key in common],
+                     dtype=float).reshape(len(common), 3),
+            np.array([coords[key] for key in common],
+                     dtype=float).reshape(len(common), 3)))
+    return pairs
+
+
+def getChainCount(fileName):
+    """ Number of chains of the first model of a PDB or mmCIF file.
+        Only the chain column of the atoms is read (see readAtoms),
+        coordinates are not parsed and no structure is built. Results
+        are kept in memory until the file changes, so repeated calls
+        (e.g. form validation) are free.
+    """
+    stat = os.stat(fileName)
+    key = (os.path.abspath(fileName), stat.st_size, stat.st_mtime)
+    if key not in _chainCounts:
+        atoms = readAtoms(fileName, records=(b'ATOM', b'HETATM'),
+                          keys=('chain',))
+        _chainCounts[key] = len(np.unique(atoms['chain']))
+    return _chainCounts[key]
+
+
+def _getChainIndexes(chains):
+    """ index of the chain of each atom, chains are numbered in
+        order of appearance"""
+    names, first, inverse = np.unique(chains, return_index=True,
+                                      return_inverse=True)
+    order = np.empty(len(names), dtype=int)
+    order[np.argsort(first)] = np.arange(len(names))
+    return order[inverse.ravel()]
+
+
+# fixed width columns of the PDB ATOM/HETATM records (python slices)
+PDB_ATOM_COLUMNS = {'name': (12, 16), 'residue': (17, 27),
+                    'resName': (17, 20), 'chain': (21, 22),
+                    'resSeq': (22, 26), 'iCode': (26, 27),
+                    'x': (30, 38), 'y': (38, 46), 'z': (46, 54),
+                    'element': (76, 78)}
+PDB_LINE_WIDTH = 80
+# bytes of the atomic structure files parsed at once
+ATOMS_CHUNK_SIZE = 2 ** 24
+
+
+def _getPdbColumn(chars, column):
+    """ column (start, end) of all the lines, chars is the (n, 80)
+        array of characters of the lines"""
+    start, end = column
+    return np.ascontiguousarray(chars[:, start:end]).view(
+        'S%d' % (end - start)).ravel()
+
+
+def _parsePdbLines(chars, keys=None):
+    """ columns of the ATOM/HETATM lines, chars is the (n, 80) array
+        of characters of the lines (see readPdbAtoms). keys: columns
+        to parse (None -> all)"""
+    atoms = {}
+    for key, column in PDB_ATOM_COLUMNS.items():
+        if key in 'xyz' or (keys is not None and key not in keys):
+            continue
+        values = _getPdbColumn(chars, column)
+        # residue is only used to find where residues change
+        atoms[key] = values if key == 'residue' else np.char.strip(values)
+    if keys is None or 'coords' in keys:
+        coords = np.empty((len(chars), 3))
+        for axis, key in enumerate('xyz'):
+            coords[:, axis] = _getPdbColumn(
+                chars, PDB_ATOM_COLUMNS[key]).astype(float)
+        atoms['coords'] = coords
+    return atoms
+
+
+def _iterPdbChunks(fileName, records, chunkSize, keys=None):
+    """ atoms of consecutive blocks of lines of a PDB file, model is the
+        number of MODEL records before each atom"""
+    records = [r.strip() for r in records]
+    models = 0
+    with open(fileName, 'rb') as f:
+        while True:
+            data = f.read(chunkSize)
+            if not data:
+                return
+            if not data.endswith(b'\n'):
+                data += f.readline()  # whole lines
+            lines = np.array(data.splitlines(), dtype='S%d' % PDB_LINE_WIDTH)
+            chars = lines.view('S1').reshape(len(lines), PDB_LINE_WIDTH)
+            recordNames = np.char.strip(_getPdbColumn(chars, (0, 6)))
+            end = np.flatnonzero(recordNames == b'END')
+            if len(end):
+                chars, recordNames = chars[:end[0]], recordNames[:end[0]]
+            model = models + np.cumsum(recordNames == b'MODEL')
+            models = model[-1] if len(model) else models
+            selected = np.isin(recordNames, records)
+            atoms = _parsePdbLines(chars[selected], keys)
+            atoms['model'] = model[selected]
+            yield atoms
+            if len(end):
+                return
+
+
+# token of a mmCIF line: quoted value (quotes may appear inside it) or word
+_CIF_TOKEN = re.compile(rb"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+# lines that end the rows of a loop
+_CIF_LOOP_END = [b'\n#', b'\n_', b'\nloop_']
+
+
+def _splitCifLine(line):
+    if b'"' not in line and b"'" not in line:
+        return line.split()
+    return [single or double or word for single, double, word in
+            _CIF_TOKEN.findall(line)]
+
+
+def _iterCifChunks(fileName, records, chunkSize, keys=None):
+    """ atoms of consecutive blocks of rows of the _atom_site loop of a
+        mmCIF file, model is the pdbx_PDB_model_num of each atom"""
+    records = [r.strip() for r in records]
+    with open(fileName, 'rb') as f:
+        # column names of the loop, the rows follow them
+        line = f.readline()
+        while line and not line.startswith(b'_atom_site.'):
+            line = f.readline()
+        columns = {}
+        while line.startswith(b'_atom_site.'):
+            columns[line.split()[0][11:].decode()] = len(columns)
+            line = f.readline()
+        nColumns = max(len(columns), 1)
+        data = line
+        while True:
+            data += f.read(chunkSize)
+            if not data:
+                return
+            if not data.endswith(b'\n'):
+                data += f.readline()  # whole lines
+            # lines that end the rows of the loop
+            ends = [(b'\n' + data).find(end) for end in _CIF_LOOP_END]
+            last = min([end for end in ends if end >= 0], default=-1)
+            block = data if last < 0 else data[:last]
+            if b'"' in block or b"'" in block:
+                tokens = [token for line in block.splitlines()
+                          for token in _splitCifLine(line)]
+            else:
+                tokens = block.split()
+            if len(tokens) % nColumns:
+                raise Exception("Can not parse the _atom_site loop of %s, "
+                                "values spanning several lines are not "
+                                "supported" % fileName)
+            yield _parseCifTokens(tokens, columns, records, keys)
+            if last >= 0:
+                return
+            data = b''
+
+
+# _atom_site columns of the atom keys, the first one present is used
+CIF_ATOM_COLUMNS = {'name': ('auth_atom_id', 'label_atom_id'),
+                    'resName': ('auth_comp_id', 'label_comp_id'),
+                    'chain': ('auth_asym_id', 'label_asym_id'),
+                    'resSeq': ('auth_seq_id', 'label_seq_id'),
+                    'iCode': ('pdbx_PDB_ins_code',),
+                    'element': ('type_symbol',)}
+
+
+def _parseCifTokens(tokens, columns, records, keys=None):
+    """ columns of the rows of the _atom_site loop (see readCifAtoms),
+        tokens are the values of the rows, columns the index of each
+        column name. keys: atom keys to convert (None -> all)"""
+    nColumns = max(len(columns), 1)
+    nAtoms = len(tokens) // nColumns
+
+    def column(*names):
+        for name in names:
+            if name in columns:
+                return np.array(tokens[columns[name]::nColumns],
+                                dtype=bytes)
+        return np.full(nAtoms, b'', dtype='S1')
+
+    selected = np.ones(nAtoms, dtype=bool)
+    if 'group_PDB' in columns:
+        selected &= np.isin(column('group_PDB'), records)
+
+    def wanted(*names):
+        return keys is None or any(name in keys for name in names)
+
+    # residue is only used to find where residues change
+    atoms = {key: column(*names)[selected]
+             for key, names in CIF_ATOM_COLUMNS.items()
+             if wanted(key, 'residue')}
+    if 'iCode' in atoms:
+        atoms['iCode'][np.isin(atoms['iCode'],
+                               [u.encode() for u in CIF_UNKNOWN])] = b''
+    if wanted('residue'):
+        atoms['residue'] = np.char.add(
+            np.char.add(np.char.add(atoms['resName'], b' '), atoms['chain']),
+            np.char.add(np.char.add(b' ', atoms['resSeq']), atoms['iCode']))
+        atoms = {key: values for key, values in atoms.items()
+                 if wanted(key)}
+    if wanted('coords'):
+        coords = np.empty((int(selected.sum()), 3))
+        for axis, name in enumerate(['Cartn_x', 'Cartn_y', 'Cartn_z']):
+            coords[:, axis] = column(name)[selected].astype(float)
+        atoms['coords'] = coords
+    atoms['model'] = column('pdbx_PDB_model_num')[selected]
+    return atoms
+
+
+def _splitModels(chunks):
+    """ atoms of each model from the atoms of consecutive chunks of a
+        file (with the model of each atom). A model may span several
+        chunks, only the pieces of the current model are kept"""
+    pending, current = [], None
+    for atoms in chunks:
+        model = atoms.pop('model')
+        starts = np.flatnonzero(model[1:] != model[:-1]) + 1
+        for start, end in zip(np.concatenate([[0], starts]),
+                              np.concatenate([starts, [len(model)]])):
+            if end <= start:
+                continue
+            if pending and model[start] != current:
+                yield _joinAtoms(pending)
+                pending = []
+            current = model[start]
+            pending.append({key: values[start:end]
+                            for key, values in atoms.items()})
+    if pending:
+        yield _joinAtoms(pending)
+
+
+def _joinAtoms(pieces):
+    if len(pieces) == 1:
+        return pieces[0]
+    return {key: np.concatenate([piece[key] for piece in pieces])
+            for key in pieces[0]}
+
+
+def _emptyAtoms(keys=None):
+    atoms = {key: np.array([], dtype='S1') for key in PDB_ATOM_COLUMNS
+             if key not in 'xyz' and (keys is None or key in keys)}
+    if keys is None or 'coords' in keys:
+        atoms['coords'] = np.empty((0, 3))
+    return atoms
+
+
+def iterModelAtoms(fileName, records=(b'ATOM',), chunkSize=ATOMS_CHUNK_SIZE):
+    """ Read in bulk the atoms of each model of a PDB or mmCIF file.
+        The file is parsed in chunks of chunkSize bytes and models are
+        yielded in file order as soon as they are read, so memory
+        depends on the size of a model, not on the number of models.
+        records: record names to read (ATOM, HETATM)
+        yield dictionaries of arrays as readAtoms
+    """
+    if isCifFile(fileName):
+        chunks = _iterCifChunks(fileName, records, chunkSize)
+    else:
+        chunks = _iterPdbChunks(fileName, records, chunkSize)
+    return _splitModels(chunks)
+
+
+def readPdbAtoms(fileName, records=(b'ATOM',), keys=None):
+    """ Read in bulk the atoms of the first model of a PDB file.
+        records: record names to read (ATOM, HETATM)
+        keys: columns to read (None -> all), e.g. ('chain',) does not
+        parse the coordinates
+        The lines are loaded in a fixed width array and each column
+        is sliced for all the atoms at once, there is no per line
+        parsing. Reading stops at the end of the first model.
+        return a dictionary of arrays with the columns of
+        PDB_ATOM_COLUMNS (stripped byte strings, comparisons are much
+        faster than with unicode) except x, y, z that are returned as
+        coords (n, 3)
+    """
+    models = _splitModels(_iterPdbChunks(fileName, records, ATOMS_CHUNK_SIZE,
+                                         keys))
+    atoms = next(models, None)
+    models.close()
+    return _emptyAtoms(keys) if atoms is None else atoms
+
+
+def readCifAtoms(fileName, records=(b'ATOM',), keys=None):
+    """ Read in bulk the atoms of the first model of a mmCIF file.
+        The rows of the _atom_site loop are split into tokens at once
+        and only the needed columns are converted, for all the atoms
+        at once.
+        records: values of group_PDB to read (ATOM, HETATM)
+        keys: columns to read (None -> all)
+        return a dictionary with the same keys than readPdbAtoms
+        (author chain, residue number and atom names if present)
+    """
+    models = _splitModels(_iterCifChunks(fileName, records, ATOMS_CHUNK_SIZE,
+                                         keys))
+    atoms = next(models, None)
+    models.close()
+    return _emptyAtoms(keys) if atoms is None else atoms
+
+
+def readAtoms(fileName, records=(b'ATOM',), keys=None):
+    """ readCifAtoms or readPdbAtoms depending on the file extension"""
+    if isCifFile(fileName):
+        return readCifAtoms(fileName, records, keys)
+    return readPdbAtoms(fileName, records, keys)
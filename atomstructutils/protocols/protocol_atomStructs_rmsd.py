@@ -24,31 +24,57 @@
 # *
 # **************************************************************************
 
-import os, shutil
+import os
+import json
 import numpy as np
 import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from pyworkflow.protocol.params import FloatParam, PointerParam, EnumParam, BooleanParam, \
-    STEPS_PARALLEL, StringParam
+    STEPS_PARALLEL, StringParam, IntParam, GE, GT
 from pyworkflow.object import Float, String
 from pwem.protocols import EMProtocol
 from pwem.convert.atom_struct import toPdb, toCIF, AtomicStructHandler, addScipionAttribute
 from pwem.objects import AtomStruct, SetOfAtomStructs
+from .. import Plugin
+from ..convert import readAtoms, iterModelAtoms, isCifFile, getFileHash
+from ..utils import (pairwiseRMSD, residueRMSD, superposedResidueRMSD, overallRMSD, confidenceInterval,
+                     getCacheKey, PairCache, RunningStatistics, linkOrCopy, shrinkNpyFile, kabsch)
+
+# rmsdMode choices
+RMSD_PAIR_STEPS, RMSD_ALL_PAIRS, RMSD_REFERENCE, RMSD_SAMPLED = 0, 1, 2, 3
+# maximum number of atoms (pairs x atoms per structure) compared at once
+RMSD_BLOCK_ATOMS = 2 ** 20
+# sampled pairs mode: pairs drawn in each round, minimum number of rounds
+# and seed of the random generator (results are reproducible)
+RMSD_SAMPLING_BATCH = 200
+RMSD_SAMPLING_MIN_ROUNDS = 3
+RMSD_SAMPLING_SEED = 0
+# minimum size in bytes of the line of an atom in a PDB or mmCIF file, it bounds
+# the number of models of a multi-model file
+RMSD_MIN_ATOM_LINE = 16
+# inputType choices
+INPUT_SET, INPUT_MODELS = 0, 1
 
 class ProtRMSDAtomStructs(EMProtocol):
     """
-    Protocol to calculate the RMSD between all pairs of atom structures in a set of them.
+    Protocol to calculate the RMSD between all pairs of atom structures in a set of them
+    (or between the models of a multi-model file).
     It calculates the overall RMSD for all of them and for each of their residues to validate
     their associated volume
     """
 
     _label = 'RMSD validate map'
     _ATTRNAME = 'perResidueRMSD'
+    # standard deviation and maximum of the RMSD of each residue
+    _ATTRNAME_STD = 'perResidueRMSD_std'
+    _ATTRNAME_MAX = 'perResidueRMSD_max'
+    # half width of the 95% confidence interval (sampled pairs mode)
+    _ATTRNAME_CI = 'perResidueRMSD_ci95'
     _OUTNAME = 'outputAtomStructs'
-    _possibleOutputs = {_OUTNAME: SetOfAtomStructs}
-
-    averageRMSDs = []
-    combinedResRMSDs = []
+    _OUTNAME_MODELS = 'outputAtomStruct'
+    _possibleOutputs = {_OUTNAME: SetOfAtomStructs, _OUTNAME_MODELS: AtomStruct}
 
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
@@ -57,15 +83,75 @@ class ProtRMSDAtomStructs(EMProtocol):
     # -------------------------- DEFINE param functions -----------------------
     def _defineParams(self, form):
         form.addSection(label='Input')
+        form.addParam('inputType', EnumParam, default=INPUT_SET,
+                      choices=['Set of atomic structures', 'Multi-model file'],
+                      label='Input type: ',
+                      help='Set of atomic structures: each structure is a file.\n'
+                           'Multi-model file: a single atomic structure with all the '
+                           'models of the ensemble (e.g. NMR), all of them are read in '
+                           'a single pass.')
         form.addParam('inputStructureSet', PointerParam,
                       pointerClass="SetOfAtomStructs", allowsNull=False,
+                      condition='inputType==%d' % INPUT_SET,
                       label='Input atomic structures.',
                       help="Set the atomic structure to be processed.\n"
                            "Supported formats are PDB or mmCIF; this last one"
                            " is especially useful for very large structures.")
+        form.addParam('inputStructure', PointerParam,
+                      pointerClass="AtomStruct", allowsNull=False,
+                      condition='inputType==%d' % INPUT_MODELS,
+                      label='Input multi-model structure.',
+                      help="Atomic structure with several models (PDB MODEL records or "
+                           "mmCIF pdbx_PDB_model_num), the models are compared.")
         form.addParam('chains', StringParam, default='',
                       label='Chains to perform the RMSD on: ',
                       help='Comma-separated chains to perform the RMSD on.\nIf empty, all chains will be used')
+        form.addParam('rmsdMode', EnumParam, default=RMSD_PAIR_STEPS,
+                      choices=['All pairs (one step per pair)',
+                               'All pairs (vectorized)',
+                               'Reference vs all',
+                               'Sampled pairs'],
+                      label='RMSD computation: ',
+                      help='One step per pair: each pair of structures is '
+                           'compared in its own step.\n'
+                           'Vectorized: the coordinates of all the structures '
+                           'are loaded at once and all the pairs are compared '
+                           'in blocks in a single step. Much faster for large '
+                           'ensembles.\n'
+                           'Reference vs all: each structure is only compared '
+                           'with a reference structure (or the mean structure), '
+                           'the cost grows linearly with the number of structures.\n'
+                           'Sampled pairs: random pairs (without replacement) are '
+                           'compared until the mean RMSD is known with the target '
+                           'precision. The '
+                           'overall and per residue RMSDs are reported with their '
+                           '95% confidence intervals.\n'
+                           'In all cases all the structures must have the same '
+                           'selected atoms.')
+        form.addParam('referenceStructure', PointerParam, pointerClass="AtomStruct",
+                      allowsNull=True, condition='rmsdMode==%d' % RMSD_REFERENCE,
+                      label='Reference structure: ',
+                      help='Structure all the others are compared with. It must have '
+                           'the same selected atoms. If empty, the mean structure of '
+                           'the ensemble is used.')
+        form.addParam('targetPrecision', FloatParam, default=0.01,
+                      condition='rmsdMode==%d' % RMSD_SAMPLED, validators=[GT(0)],
+                      label='Target precision (A): ',
+                      help='Pairs are sampled until the half width of the 95% '
+                           'confidence interval of the overall RMSD is below this value.')
+        form.addParam('maxPairs', IntParam, default=10000,
+                      condition='rmsdMode==%d' % RMSD_SAMPLED, validators=[GE(1)],
+                      label='Maximum number of pairs: ',
+                      help='Sampling stops after this number of pairs even if the '
+                           'target precision has not been reached. If there are no more '
+                           'pairs of structures than this, all of them are compared.')
+        form.addParam('superpose', BooleanParam, default=False,
+                      label='Superpose structures: ',
+                      help='If set, the structures of each pair are superposed (least squares fit '
+                           'of the selected atoms, Kabsch algorithm) before measuring the overall '
+                           'and per residue RMSDs, so rigid offsets between the models are not '
+                           'counted as deviations. Otherwise the RMSDs are measured in the '
+                           'deposited frame.')
 
         group = form.addGroup('Atoms')
         group.addParam('considerAtoms', EnumParam, default=0,
@@ -77,6 +163,12 @@ class ProtRMSDAtomStructs(EMProtocol):
         group.addParam('hydrogen', BooleanParam, default=False,
                        label='Consider hydrogens: ',
                        help='Consider hydrogens into calculation')
+        form.addParam('useCache', BooleanParam, default=True,
+                      label='Reuse previous results: ',
+                      help='If set, the RMSDs of each pair of structures are stored in a cache '
+                           '(see ATOMSTRUCTUTILS_CACHE) indexed by the content of both files, with a '
+                           'store per atom selection, and pairs already computed, e.g. when a few '
+                           'structures are added to a set, are not computed again.')
 
         form.addParallelSection(threads=4, mpi=1)
 
@@ -85,89 +177,372 @@ class ProtRMSDAtomStructs(EMProtocol):
         convId = self._insertFunctionStep('convertInputStep', prerequisites=[])
 
         rmsdIds = []
-        for comboFn in itertools.combinations(self.getInputFileNames(), 2):
-            rmsdIds.append(self._insertFunctionStep('calculateRMSDStep', comboFn, prerequisites=[convId]))
+        if self.rmsdMode.get() == RMSD_ALL_PAIRS:
+            rmsdIds.append(self._insertFunctionStep('calculateAllRMSDStep', prerequisites=[convId]))
+        elif self.rmsdMode.get() == RMSD_REFERENCE:
+            rmsdIds.append(self._insertFunctionStep('calculateReferenceRMSDStep', prerequisites=[convId]))
+        elif self.rmsdMode.get() == RMSD_SAMPLED:
+            rmsdIds.append(self._insertFunctionStep('calculateSampledRMSDStep', prerequisites=[convId]))
+        else:
+            for comboFn in itertools.combinations(self.getInputFileNames(), 2):
+                rmsdIds.append(self._insertFunctionStep('calculateRMSDStep', comboFn, prerequisites=[convId]))
 
         self._insertFunctionStep('createOutputStep', prerequisites=rmsdIds)
 
     # --------------------------- STEPS functions ----------------------------
     def convertInputStep(self):
-        for inFn in self.getInputFileNames():
-            if not inFn.endswith('.pdb'):
-                name, ext = os.path.splitext(inFn)
-                toPdb(os.path.abspath(inFn), self._getExtraPath(os.path.basename(inFn).replace(ext, '.pdb')))
+        selection = (self.hydrogen.get(), self.getChainList(), self.getRMSDAtoms(), self.weightbb.get())
+        if self.isMultiModel():
+            # the models are read one at a time in a single pass, each one is a structure.
+            # Their number is only known at the end, the coordinates file is created with
+            # room for as many models as the file can hold and shrunk at the end
+            inFn = self.inputStructure.get().getFileName()
+            structures = (select_coordinates(atoms, *selection) for atoms in iterModelAtoms(inFn))
+            names, maxStructures = [], None
+        else:
+            names = self.getInputFileNames()
+            self.writeInputIndex(names)
+            structures = (get_coordinates(self.getConvertedFile(inFn), *selection) for inFn in names)
+            maxStructures = len(names)
+
+        # parse each structure only once, the selected coordinates of all of them
+        # are stacked in a (M, N, 3) array on disk that the RMSD steps memory map
+        coords, resCounts = None, None
+        for i, (V, counts, reslist) in enumerate(structures):
+            if self.isMultiModel():
+                names.append('%s model %d' % (inFn, i + 1))
+            if coords is None:
+                resCounts = counts
+                np.save(self.getResidueCountsFile(), counts)
+                np.save(self.getResidueLabelsFile(), np.array(reslist, dtype=str))
+                if maxStructures is None:
+                    # each selected atom of a model is a line of the file
+                    maxStructures = os.path.getsize(inFn) // (RMSD_MIN_ATOM_LINE * max(len(V), 1)) + 1
+                coords = np.lib.format.open_memmap(self.getCoordinatesFile(), mode='w+',
+                                                   shape=(maxStructures,) + V.shape)
+            elif not np.array_equal(counts, resCounts):
+                raise Exception("Error: files [%s, %s] do not have the same atoms, %i vs. %i residues "
+                                "and %i vs. %i atoms" % (names[0], names[i], len(resCounts), len(counts),
+                                                         sum(resCounts), sum(counts)))
+            coords[i] = V
+        if coords is not None:
+            coords.flush()
+            del coords
+            if len(names) < maxStructures:
+                shrinkNpyFile(self.getCoordinatesFile(), len(names))
+
+        if len(names) < 2:
+            # e.g. a multi-model file with a single model
+            raise Exception("Error: at least two structures are needed to compute RMSDs, "
+                            "%d found" % len(names))
+
+        # content of the files, used to reuse previous results
+        if self.isMultiModel():
+            fileHash = getFileHash(inFn)
+            hashes = ['%s:%d' % (fileHash, i) for i in range(len(names))]
+        else:
+            hashes = [getFileHash(inFn) for inFn in names]
+        np.save(self.getFileHashesFile(), np.array(hashes, dtype=str))
+        self.createResultFiles(len(names), 0 if resCounts is None else len(resCounts))
+        os.makedirs(self._getExtraPath('pairs'), exist_ok=True)
+        if self.useCache and self.rmsdMode.get() == RMSD_PAIR_STEPS:
+            # pairs computed in previous runs are filled here, their steps do nothing
+            rmsds, residues = self.getResults(mode='r+')
+            found = self.getPairCache().load(self.getPairHashes(), rmsd=rmsds, residues=residues)
+            self.fillRMSDMatrix(rmsds)
+            for result in [rmsds, residues]:
+                result.flush()
+            print("%d pairs of structures reused" % len(found))
+
+    def writeInputIndex(self, inFns):
+        """Index of each input file: row in the result files and file to parse.
+        PDB inputs are linked and other formats converted to PDB"""
+        inputIndex, usedNames = {}, set()
+        for i, inFn in enumerate(inFns):
+            if isCifFile(inFn):
+                convFn = inFn  # mmCIF files are read directly, no conversion needed
             else:
-                shutil.copy(inFn, self._getExtraPath(os.path.basename(inFn)))
-
+                name = os.path.splitext(os.path.basename(inFn))[0] + '.pdb'
+                if name in usedNames:
+                    name = '%d_%s' % (i, name)
+                usedNames.add(name)
+                convFn = self._getExtraPath(name)
+                if not inFn.endswith('.pdb'):
+                    toPdb(os.path.abspath(inFn), convFn)
+                else:
+                    linkOrCopy(inFn, convFn)
+            inputIndex[inFn] = {'row': i, 'converted': convFn}
+        with open(self.getInputIndexFile(), 'w') as f:
+            json.dump(inputIndex, f)
+        self._inputIndex = inputIndex
 
     def calculateRMSDStep(self, combo):
-        pdbFiles = self.getConvertedFile(combo[0]), self.getConvertedFile(combo[1])
+        # coordinates parsed by convertInputStep, same atoms in both structures
+        i, j = self.getInputRow(combo[0]), self.getInputRow(combo[1])
+        k = pair_index(i, j, len(self.getFileHashes()))
+        rmsds, _ = self.getResults()
+        if not np.isnan(rmsds[k]):
+            print("RMSD %s to %s: %.4f (reused)" % (os.path.basename(combo[0]), os.path.basename(combo[1]),
+                                                    rmsds[k]))
+            return
+        coords = self.getCoordinates()
+        P, Q = coords[i], coords[j]
+
+        # Calculate per-residue RMSD, a segment reduction over the residue boundaries
+        resCounts = self.getResidueCounts()
+        per_res_rmsd = self.getResidueRMSD(P, Q, resCounts)
 
-        if self.chains.get().strip() == '':
-            chainlist = None
+        # Calculate overall RMSD
+        rmsdval = overallRMSD(per_res_rmsd, resCounts) if self.superpose else rmsd(P, Q)
+
+        # steps may run in different processes or hosts (MPI), each one writes
+        # its own file and createOutputStep gathers them in the result files
+        np.savez(self.getPairResultFile(k), rmsd=rmsdval, residues=per_res_rmsd)
+        print("RMSD %s to %s: %.4f" % (os.path.basename(combo[0]), os.path.basename(combo[1]), rmsdval))
+    
+    def calculateAllRMSDStep(self):
+        """Compute the RMSD of all the pairs of structures at once.
+        Coordinates are stacked in a (M, N, 3) array, the overall RMSD matrix
+        comes from the Gram matrix (without superposition) and per residue RMSDs
+        are computed in blocks of pairs"""
+        coords = np.array(self.getCoordinates())
+        resCounts = self.getResidueCounts()
+        first, second = np.triu_indices(len(coords), 1)
+
+        rmsds, residuesOut = self.getResults(mode='r+')
+
+        # pairs computed in previous runs, the hashes of the pairs are only built to use the cache
+        found = self.getPairCache().load(self.getPairHashes(first, second), rmsd=rmsds,
+                                         residues=residuesOut) if self.useCache else []
+        missing = np.setdiff1d(np.arange(len(first)), found)
+
+        # overall RMSD of the missing pairs, a single matrix product per block
+        # of rows, only the rows of the missing pairs are computed.
+        # Superposed pairs are compared in different frames, the overall RMSD
+        # comes from the per residue ones
+        if len(missing) and not self.superpose:
+            rows, rowIndexes = np.unique(first[missing], return_inverse=True)
+            rmsdRows = pairwiseRMSD(coords, rows)
+
+        # per residue RMSD of the missing pairs, pairs are compared in blocks
+        blockSize = max(1, RMSD_BLOCK_ATOMS // max(coords.shape[1], 1))
+        for start in range(0, len(missing), blockSize):
+            block = missing[start:start + blockSize]
+            residues = self.getResidueRMSD(coords[first[block]], coords[second[block]], resCounts)
+            if self.superpose:
+                rmsds[block] = overallRMSD(residues, resCounts)
+            else:
+                rmsds[block] = rmsdRows[rowIndexes[start:start + blockSize], second[block]]
+            residuesOut[block] = residues
+        if self.useCache and len(missing):
+            self.getPairCache().save(self.getPairHashes(first[missing], second[missing]), rows=missing,
+                                     rmsd=rmsds, residues=residuesOut)
+
+        self.fillRMSDMatrix(rmsds)
+        for result in [rmsds, residuesOut]:
+            result.flush()
+        print("RMSD computed for %d pairs of structures, %d reused" % (len(first), len(first) - len(missing)))
+
+    def calculateReferenceRMSDStep(self):
+        """Compare each structure with the reference structure, or with the mean
+        structure if there is no reference, O(M) instead of O(M^2) pairs"""
+        coords = self.getCoordinates()
+        resCounts = self.getResidueCounts()
+        hashes = self.getFileHashes()
+        blockSize = max(1, RMSD_BLOCK_ATOMS // max(coords.shape[1], 1))
+        if self.referenceStructure.get() is not None:
+            referenceFn = self.referenceStructure.get().getFileName()
+            reference, counts, _ = get_coordinates(referenceFn, self.hydrogen.get(), self.getChainList(),
+                                                   self.getRMSDAtoms(), self.weightbb.get())
+            if not np.array_equal(counts, resCounts):
+                raise Exception("Error: reference %s does not have the same atoms than the input structures"
+                                % referenceFn)
+            referenceHash = getFileHash(referenceFn)
         else:
-            chainlist = self.chains.get().split(',')
-        P, Pres, self.Preslist = get_coordinates(pdbFiles[0], self.hydrogen.get(), chainlist, self.getRMSDAtoms(),
-                                            self.weightbb.get())
-        Q, Qres, Qreslist = get_coordinates(pdbFiles[1], self.hydrogen.get(), chainlist, self.getRMSDAtoms(),
-                                            self.weightbb.get())
-        # checking that files have same number of residues
-        if (len(Pres) != len(Qres)):
-            exit("Error: files [%s, %s] do not have same number of residues, %i vs. %i" % (
-            pdbFiles[0], pdbFiles[1], len(Pres), len(Qres)))
+            # mean structure, computed by blocks of structures. If the pairs are
+            # superposed the structures are first superposed onto the first one
+            reference = np.zeros(coords.shape[1:])
+            for start in range(0, len(coords), blockSize):
+                block = np.asarray(coords[start:start + blockSize], dtype=float)
+                if self.superpose:
+                    matrices, _ = kabsch(coords[0], block)
+                    block = np.matmul(block, matrices[:, :3, :3].transpose(0, 2, 1)) + matrices[:, None, :3, 3]
+                reference += block.sum(axis=0)
+            reference /= max(len(coords), 1)
+            referenceHash = None  # depends on the whole ensemble, not cached
+
+        # the reference itself (if it is in the set) is not compared
+        indexes = [i for i in range(len(coords)) if hashes[i] != referenceHash]
+        if not indexes:
+            raise Exception("Error: all the input structures are the reference %s, there is "
+                            "nothing to compare" % referenceFn)
+        # row i of the results is the i-th structure
+        rmsds, residuesOut = self.getResults(mode='r+')
+        useCache = self.useCache.get() and referenceHash is not None
+        pairs = [(referenceHash, hashes[i]) for i in indexes]
+        found = self.getPairCache().load(pairs, rows=indexes, rmsd=rmsds, residues=residuesOut) \
+            if useCache else []
+        missing = np.array([indexes[n] for n in np.setdiff1d(np.arange(len(indexes)), found)],
+                           dtype=int)
+        for start in range(0, len(missing), blockSize):
+            block = missing[start:start + blockSize]
+            residues = self.getResidueRMSD(coords[block], reference, resCounts)
+            rmsds[block] = overallRMSD(residues, resCounts)
+            residuesOut[block] = residues
+        if useCache and len(missing):
+            self.getPairCache().save([(referenceHash, hashes[i]) for i in missing], rows=missing,
+                                     rmsd=rmsds, residues=residuesOut)
+        rmsds.flush()
+        residuesOut.flush()
+        print("RMSD to the reference computed for %d structures, %d reused" %
+              (len(indexes), len(indexes) - len(missing)))
+
+    def calculateSampledRMSDStep(self):
+        """Compare random pairs of structures until the half width of the 95%
+        confidence interval of the mean RMSD is below targetPrecision.
+        Pairs are drawn without replacement, if maxPairs covers all of them
+        every pair is compared (the mean is exact)"""
+        coords = self.getCoordinates()
+        resCounts = self.getResidueCounts()
+        M = len(coords)
+        P = M * (M - 1) // 2
+        blockSize = max(1, RMSD_BLOCK_ATOMS // max(coords.shape[1], 1))
+        exhaustive = self.maxPairs.get() >= P
+        if exhaustive:
+            pairIndexes = np.arange(P)
         else:
-            self.numRes = len(Qres)
-
-        # Calculate per-residue RMSD
-        per_res_rmsd = []
-        for i in range(len(Pres)):
-            res1 = np.asarray(Pres[i])
-            res2 = np.asarray(Qres[i])
-            per_res_rmsd.append(rmsd(res1, res2))
+            rng = np.random.default_rng(RMSD_SAMPLING_SEED)
+            pairIndexes = rng.choice(P, self.maxPairs.get(), replace=False)
+        # row n of the results is the n-th sampled pair, unused rows are NaN
+        rmsds, residues = self.getResults(mode='r+')
+        n = rounds = 0
+        while n < len(pairIndexes):
+            size = min(RMSD_SAMPLING_BATCH, len(pairIndexes) - n)
+            first, second = pair_from_index(pairIndexes[n:n + size], M)
+            # rows are read from disk in order
+            order = np.argsort(first, kind='stable')
+            first, second = first[order], second[order]
+            for start in range(0, size, blockSize):
+                end = min(start + blockSize, size)
+                blockResidues = self.getResidueRMSD(coords[first[start:end]], coords[second[start:end]],
+                                                    resCounts)
+                residues[n + start:n + end] = blockResidues
+                rmsds[n + start:n + end] = overallRMSD(blockResidues, resCounts)
+            n += size
+            rounds += 1
+            if exhaustive:
+                continue
+            precision = confidenceInterval(rmsds[:n], population=P)
+            print("%d pairs sampled, RMSD %.4f +/- %.4f" % (n, np.mean(rmsds[:n]), precision))
+            if rounds >= RMSD_SAMPLING_MIN_ROUNDS and precision <= self.targetPrecision.get():
+                break
+        if exhaustive:
+            print("All the %d pairs compared, RMSD %.4f" % (n, np.mean(rmsds[:n])))
+        rmsds.flush()
+        residues.flush()
 
-        # Calculate overall RMSD
-        rmsdval = rmsd(P, Q)
-        self.averageRMSDs.append(rmsdval)
-        self.combinedResRMSDs.append(per_res_rmsd)
-        print("RMSD %s to %s: %.4f" % (os.path.basename(pdbFiles[0]), os.path.basename(pdbFiles[1]), rmsdval))
-    
     def createOutputStep(self):
+        if self.rmsdMode.get() == RMSD_PAIR_STEPS:
+            self.gatherPairResults()
+            if self.useCache:
+                # the steps of each pair run concurrently, the cache is only written here
+                self.updatePairCache()
         outStructFileBase = self._getPath('{}.cif')
-        overFinalRMSD = np.mean(self.averageRMSDs)
+        overallStats, residueStats = self.getRMSDStatistics()
+        if overallStats.count == 0:
+            raise Exception("Error: no pair of structures was compared")
+        overFinalRMSD = overallStats.mean[0]
         print("Overall RMSD:", overFinalRMSD)
-        rmsdAttrDic = self.getRMSDAttributeDic()
-
-        ASH = AtomicStructHandler()
-        outSet = SetOfAtomStructs.create(self._getPath())
-        for AS in self.inputStructureSet.get():
-            outStructFileName = outStructFileBase.format(os.path.splitext(os.path.basename(AS.getFileName()))[0])
-            inpAS = toCIF(AS.getFileName(), self._getTmpPath('inputStruct.cif'))
-            cifDic = ASH.readLowLevel(inpAS)
-            cifDic = addScipionAttribute(cifDic, rmsdAttrDic, self._ATTRNAME)
-            ASH._writeLowLevel(outStructFileName, cifDic)
-
+        attrDics = {self._ATTRNAME: self.getResidueAttributeDic(residueStats.mean),
+                    self._ATTRNAME_STD: self.getResidueAttributeDic(residueStats.std),
+                    self._ATTRNAME_MAX: self.getResidueAttributeDic(residueStats.max)}
+        sampled = self.rmsdMode.get() == RMSD_SAMPLED
+        if sampled:
+            # pairs are a random sample, report the precision of the estimates
+            # drawn without replacement from the pairs of structures
+            M = len(self.getFileHashes())
+            population = M * (M - 1) // 2
+            overallCI = overallStats.confidenceInterval(population=population)[0]
+            print("95%% confidence interval: %.4f +/- %.4f" % (overFinalRMSD, overallCI))
+            attrDics[self._ATTRNAME_CI] = self.getResidueAttributeDic(
+                residueStats.confidenceInterval(population=population))
+
+        if self.isMultiModel():
+            # a single file with all the models
+            inputStructure = self.inputStructure.get()
+            inFn = inputStructure.getFileName()
+            outStructFileName = outStructFileBase.format(os.path.splitext(os.path.basename(inFn))[0])
+            _initOutputWorker(attrDics)
+            writeAnnotatedStructure((inFn, outStructFileName, self._getTmpPath('inputStruct.cif')))
+            outAS = inputStructure.clone()
+            outAS.setFileName(outStructFileName)
+            outAS.overallRMSD = Float(overFinalRMSD)
+            if sampled:
+                outAS.overallRMSDci95 = Float(overallCI)
+            self._defineOutputs(**{self._OUTNAME_MODELS: outAS})
+            self._defineSourceRelation(self.inputStructure, outAS)
+            return
+
+        # annotated files are written concurrently, the set is filled here
+        outStructs, tasks = [], []
+        for i, AS in enumerate(self.inputStructureSet.get()):
+            inFn = AS.getFileName()
+            outStructFileName = outStructFileBase.format(os.path.splitext(os.path.basename(inFn))[0])
+            tasks.append((inFn, outStructFileName, self._getTmpPath('inputStruct_%d.cif' % i)))
             outAS = AS.clone()
             outAS.setFileName(outStructFileName)
-            outSet.append(outAS.clone())
+            outStructs.append(outAS)
+
+        numberOfWorkers = min(max(1, self.numberOfThreads.get()), len(tasks))
+        if numberOfWorkers <= 1:
+            _initOutputWorker(attrDics)
+            for task in tasks:
+                writeAnnotatedStructure(task)
+        else:
+            with ProcessPoolExecutor(max_workers=numberOfWorkers,
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_initOutputWorker,
+                                     initargs=(attrDics,)) as executor:
+                list(executor.map(writeAnnotatedStructure, tasks,
+                                  chunksize=max(1, len(tasks) // (4 * numberOfWorkers))))
+
+        outSet = SetOfAtomStructs.create(self._getPath())
+        for outAS in outStructs:
+            outSet.append(outAS)
 
         outSet.overallRMSD = Float(overFinalRMSD)
+        if sampled:
+            outSet.overallRMSDci95 = Float(overallCI)
         self._defineOutputs(**{self._OUTNAME:outSet})
 
 
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
         errors = []
+        if self.isMultiModel():
+            if self.rmsdMode.get() == RMSD_PAIR_STEPS:
+                errors.append('One step per pair is not available for multi-model files, '
+                              'use the vectorized computation')
+        elif len(self.inputStructureSet.get()) < 2:
+            errors.append('At least two structures are needed to compute RMSDs')
         return errors
 
     def _summary(self):
         summary = []
         try:
-            summary.append('Overall RMSD: {:.4f}\n'.format(float(self.outputAtomStructs.overallRMSD)))
+            output = getattr(self, self._OUTNAME_MODELS if self.isMultiModel() else self._OUTNAME)
+            summary.append('Overall RMSD: {:.4f}\n'.format(float(output.overallRMSD)))
+            if hasattr(output, 'overallRMSDci95'):
+                summary.append('95% confidence interval: +/- {:.4f}\n'.format(
+                    float(output.overallRMSDci95)))
         except:
             summary = ["Overall RMSD not yet computed"]
         return summary
 
     # --------------------------- UTILS functions ----------------------------
+    def isMultiModel(self):
+        return self.inputType.get() == INPUT_MODELS
+
     def getInputFileNames(self):
         fns = []
         for AS in self.inputStructureSet.get():
@@ -177,11 +552,148 @@ class ProtRMSDAtomStructs(EMProtocol):
     def getInputVolume(self):
         return self.inputStructureSet.get().getFirstItem().getVolume()
 
+    def getInputIndexFile(self):
+        """input file -> row in the result files and converted file, written by convertInputStep"""
+        return self._getExtraPath('inputIndex.json')
+
+    def getInputIndex(self):
+        if getattr(self, '_inputIndex', None) is None:
+            with open(self.getInputIndexFile()) as f:
+                self._inputIndex = json.load(f)
+        return self._inputIndex
+
+    def getInputRow(self, inFile):
+        return self.getInputIndex()[inFile]['row']
+
     def getConvertedFile(self, inFile):
-        name, ext = os.path.splitext(os.path.basename(inFile))
-        for file in os.listdir(self._getExtraPath()):
-            if name in file:
-                return self._getExtraPath(file)
+        return self.getInputIndex()[inFile]['converted']
+
+    def getCoordinatesFile(self):
+        """(M, N, 3) selected coordinates of the input structures, in input order"""
+        return self._getExtraPath('coordinates.npy')
+
+    def getResidueCountsFile(self):
+        return self._getExtraPath('residueCounts.npy')
+
+    def getResidueLabelsFile(self):
+        return self._getExtraPath('residueLabels.npy')
+
+    def getCoordinates(self):
+        return np.load(self.getCoordinatesFile(), mmap_mode='r')
+
+    def getResidueCounts(self):
+        return np.load(self.getResidueCountsFile())
+
+    def getResidueLabels(self):
+        return np.load(self.getResidueLabelsFile()).tolist()
+
+    def getResultsFiles(self):
+        """overall RMSD (P,) and per residue RMSD (P, R) of each comparison (pair of
+        structures or structure vs reference), written by the RMSD steps"""
+        return self._getExtraPath('rmsds.npy'), self._getExtraPath('residueRMSDs.npy')
+
+    def getRMSDMatrixFile(self):
+        """(M, M) RMSD of every pair of structures (all pairs modes)"""
+        return self._getExtraPath('rmsdMatrix.npy')
+
+    def getNumberOfComparisons(self, M):
+        if self.rmsdMode.get() == RMSD_REFERENCE:
+            return M
+        elif self.rmsdMode.get() == RMSD_SAMPLED:
+            return min(self.maxPairs.get(), M * (M - 1) // 2)
+        return M * (M - 1) // 2
+
+    def createResultFiles(self, M, R):
+        """Preallocate the result files on disk, filled with NaN (not computed).
+        They are written by a single process: the step that compares all the pairs
+        in the vectorized, reference and sampled modes, or createOutputStep, that
+        gathers the files written by the steps of each pair"""
+        rmsdsFn, residuesFn = self.getResultsFiles()
+        P = self.getNumberOfComparisons(M)
+        shapes = [(rmsdsFn, (P,)), (residuesFn, (P, R))]
+        if self.rmsdMode.get() in [RMSD_PAIR_STEPS, RMSD_ALL_PAIRS]:
+            shapes.append((self.getRMSDMatrixFile(), (M, M)))
+        for fileName, shape in shapes:
+            result = np.lib.format.open_memmap(fileName, mode='w+', dtype=float, shape=shape)
+            result[:] = np.nan
+            if fileName == self.getRMSDMatrixFile():
+                np.fill_diagonal(result, 0.)
+            result.flush()
+            del result
+
+    def getPairResultFile(self, k):
+        """overall and per residue RMSD of the k-th pair, written by calculateRMSDStep"""
+        return self._getExtraPath('pairs', 'pair_%d.npz' % k)
+
+    def gatherPairResults(self):
+        """Copy the RMSDs written by the steps of each pair to the result files and
+        the RMSD matrix. Pairs reused from the cache are already there"""
+        rmsds, residues = self.getResults(mode='r+')
+        for k in np.flatnonzero(np.isnan(rmsds)):
+            with np.load(self.getPairResultFile(k)) as data:
+                rmsds[k], residues[k] = data['rmsd'], data['residues']
+        self.fillRMSDMatrix(rmsds)
+        for result in [rmsds, residues]:
+            result.flush()
+
+    def getResults(self, mode='r'):
+        return tuple(np.load(fileName, mmap_mode=mode) for fileName in self.getResultsFiles())
+
+    def getRMSDMatrix(self, mode='r'):
+        return np.load(self.getRMSDMatrixFile(), mmap_mode=mode)
+
+    def getFileHashesFile(self):
+        return self._getExtraPath('fileHashes.npy')
+
+    def getFileHashes(self):
+        return np.load(self.getFileHashesFile()).tolist()
+
+    def getPairHashes(self, first=None, second=None):
+        """Hashes of the structures of the pairs (first[n], second[n]), by default all the
+        pairs ordered as np.triu_indices. Only the pairs to look up or store in the cache
+        should be requested, the list takes about 400 bytes per pair"""
+        hashes = np.array(self.getFileHashes())
+        if first is None:
+            first, second = np.triu_indices(len(hashes), 1)
+        return list(zip(hashes[first].tolist(), hashes[second].tolist()))
+
+    def getPairCache(self):
+        """RMSDs of pairs of structures computed in previous runs, indexed by the content of
+        both files (hashes). There is a store per atom selection and superposition"""
+        return PairCache(Plugin.getCacheDir(),
+                         getCacheKey('rmsd', self.chains.get().strip(), self.considerAtoms.get(),
+                                     self.hydrogen.get(), self.weightbb.get(), self.superpose.get()))
+
+    def updatePairCache(self):
+        """Store the RMSDs of the pairs that were not in the cache"""
+        first, second = np.triu_indices(len(self.getFileHashes()), 1)
+        pairCache = self.getPairCache()
+        missing = np.setdiff1d(np.arange(len(first)), pairCache.load(self.getPairHashes(first, second)))
+        if len(missing):
+            rmsds, residues = self.getResults()
+            pairCache.save(self.getPairHashes(first[missing], second[missing]), rows=missing,
+                           rmsd=rmsds, residues=residues)
+
+    def fillRMSDMatrix(self, rmsds):
+        """Copy the RMSDs of the pairs (ordered as np.triu_indices, see pair_index) to the
+        (M, M) RMSD matrix"""
+        matrix = self.getRMSDMatrix(mode='r+')
+        first, second = np.triu_indices(len(matrix), 1)
+        matrix[first, second] = rmsds
+        matrix[second, first] = rmsds
+        matrix.flush()
+
+    def getResidueRMSD(self, first, second, resCounts):
+        """Per residue RMSDs of pairs of structures (see utils.residueRMSD), second is
+        superposed onto first if superpose is set. Blocks of pairs are superposed at once"""
+        if self.superpose:
+            return superposedResidueRMSD(first, second, resCounts)
+        return residueRMSD(first, second, resCounts)
+
+    def getChainList(self):
+        if self.chains.get().strip() == '':
+            return None
+        return self.chains.get().split(',')
 
     def getRMSDAtoms(self):
         if self.considerAtoms.get() == 0:
@@ -194,110 +706,138 @@ class ProtRMSDAtomStructs(EMProtocol):
     def getRMSDAttributeDic(self):
         '''Return a dictionary with {spec: value}
         "spec" should be a chimera specifier'''
-        combinedResAvgs = []
-        # get average per-residue RMSD
-        for i in range(self.numRes):
-            rmsdval = 0
-            for struct in self.combinedResRMSDs:
-                rmsdval += struct[i]
-            # this gives us mean RMSD for this residue
-            rmsdval /= len(self.combinedResRMSDs)
-            combinedResAvgs.append(rmsdval)
-
+        # average per-residue RMSD
+        return self.getResidueAttributeDic(self.getRMSDStatistics()[1].mean)
+
+    def getRMSDStatistics(self):
+        """Statistics of the overall and per residue RMSDs written by the RMSD steps.
+        Rows are read in blocks and accumulated, memory is O(residues) whatever
+        the number of comparisons. Rows not computed (NaN) are skipped.
+        return RunningStatistics of the overall RMSD and of the per residue RMSDs"""
+        rmsds, residues = self.getResults()
+        overallStats = RunningStatistics(1)
+        residueStats = RunningStatistics(residues.shape[1])
+        blockSize = max(1, RMSD_BLOCK_ATOMS // max(residues.shape[1], 1))
+        for start in range(0, len(rmsds), blockSize):
+            end = start + blockSize
+            computed = ~np.isnan(rmsds[start:end])
+            overallStats.update(rmsds[start:end][computed])
+            residueStats.update(residues[start:end][computed])
+        return overallStats, residueStats
+
+    def getResidueAttributeDic(self, values):
+        """Return a dictionary with {spec: value} for the per residue values"""
         attrDic = {}
-        for i in range(len(combinedResAvgs)):
-            resId = '{}:{}'.format(self.Preslist[i][4], self.Preslist[i][5:].strip())
-            attrDic[resId] = str(round(combinedResAvgs[i], 4))
+        for resId, value in zip(self.getResidueLabels(), values):
+            # residues without selected atoms have no RMSD
+            if np.isnan(value):
+                continue
+            attrDic[resId] = str(round(value, 4))
         return attrDic
 
 
+# attributes added by the output workers, set once per worker process
+_outputAttrDics = None
+
+
+def _initOutputWorker(attrDics):
+    global _outputAttrDics
+    _outputAttrDics = attrDics
+
+
+def writeAnnotatedStructure(task):
+    """Writes a copy of an atom structure with the RMSD attributes.
+    task: (input file, output cif file, tmp file for the conversion)
+    mmCIF inputs are read directly, other formats are converted first"""
+    inFn, outFn, tmpFn = task
+    if not isCifFile(inFn):
+        inFn = toCIF(inFn, tmpFn)
+    ASH = AtomicStructHandler()
+    cifDic = ASH.readLowLevel(inFn)
+    for attrName, attrDic in _outputAttrDics.items():
+        cifDic = addScipionAttribute(cifDic, attrDic, attrName)
+    ASH._writeLowLevel(outFn, cifDic)
+    if inFn == tmpFn:
+        os.remove(tmpFn)
+    return outFn
+
+
+def pair_index(i, j, M):
+    """Position of the pair (i, j), i < j, in the list of pairs of M structures
+    ordered as np.triu_indices(M, 1)"""
+    return i * M - i * (i + 1) // 2 + j - i - 1
+
+
+def pair_from_index(k, M):
+    """Inverse of pair_index: pairs (first, second) at positions k (array) of the list
+    of pairs of M structures ordered as np.triu_indices(M, 1)"""
+    k = np.asarray(k, dtype=np.int64)
+    b = 2 * M - 1
+    first = np.floor((b - np.sqrt(np.maximum(b * b - 8. * k, 0.))) / 2).astype(np.int64)
+    # correct the rounding errors of the square root
+    first = np.clip(first, 0, max(M - 2, 0))
+    first[pair_index(first, first + 1, M) > k] -= 1
+    first[pair_index(first + 1, first + 2, M) <= k] += 1
+    second = k - pair_index(first, first + 1, M) + first + 1
+    return first, second
+
+
 def rmsd(V, W):
     """
     Calculate Root-mean-square deviation from two sets of vectors V and W.
     """
-    D = len(V[0])
-    N = len(V)
-    rmsd = 0.0
-    for v, w in zip(V, W):
-        rmsd += sum([(v[i] - w[i]) ** 2.0 for i in range(D)])
-    return np.sqrt(rmsd / N)
+    diff = np.asarray(V, dtype=float) - np.asarray(W, dtype=float)
+    if not len(diff):
+        return np.nan
+    return np.sqrt(np.einsum('ij,ij->', diff, diff) / len(diff))
 
 
 def get_coordinates(filename, hydrogen, chain=None, backbone=None, weight=1.0):
     """
-    Get coordinates from the first chain in a pdb file
-    and return a vectorset with all the coordinates.
+    Get coordinates from the first model of a pdb or mmCIF file.
+    return the (n, 3) coordinates of the selected atoms, the number of selected atoms
+    of each residue (atoms of a residue are consecutive) and the residue labels (chain:number)
     """
-    atomlist = ["C", "N", "O", "S", "P"]
-    if hydrogen:
-        atomlist.append("H")
-
-    x_column = None
-    V = []
+    return select_coordinates(readAtoms(filename), hydrogen, chain, backbone, weight)
 
-    # resarray contains the coordinates
-    resarray = []
 
-    # reslist contains the residue name and number
-    reslist = []
-
-    prevres = ""
-    with open(filename) as f:
-        lines = f.readlines()
-        for line in lines:
-            #			if line.startswith("TER") or line.startswith("END"):
-            if line.startswith("END"):
-                break
-            if line.startswith("ATOM"):
-                # establish backbone atoms
-                backatoms = ['N', 'CA', 'C', 'O']
-
-                # if specific chain is specified, only process that chain
-                if chain is not None:
-                    if line[21] not in chain: continue
-
-                # see if it's a nucleic acid
-                if backbone == 'CA': backatoms = ['CA']
-                if line[17:20].strip() in ['DA', 'DC', 'DG', 'DT', 'DI', 'A', 'C', 'G', 'U', 'I']:
-                    # add P for RNA/DNA
-                    backatoms = ["P", "OP1", "OP2", "O3'", "O5'", "C3'", "C4'", "C5'"]
-                    if backbone == 'CA': backatoms = ["C3'", "C4'"]
-                tokens = line.split()
-                # Try to get the residue
-                try:
-                    res = line[17:27]
-                    # if moved to next residue:
-                    if res != prevres:
-                        reslist.append(res)
-                        if prevres != "":
-                            resarray.append(presarray)
-                        presarray = []
-                        prevres = res
-                except:
-                    exit("Error parsing residue type for the following line: \n%s" % line)
-                # Try to get the atomtype
-                try:
-                    atom = tokens[-1][0]
-                    if atom not in atomlist: continue
-
-                    # check if a backbone atom
-                    multiplier = weight
-                    if line[12:16].strip() not in backatoms:
-                        if backbone is not None: continue
-                        multiplier = 1.0 / weight
-
-                except:
-                    exit("Error parsing atomtype for the following line: \n%s" % line)
-
-                try:
-                    x = line[30:38]
-                    y = line[38:46]
-                    z = line[46:54]
-                    V.append(np.asarray([x, y, z], dtype=float) * multiplier)
-                    presarray.append(np.asarray([x, y, z], dtype=float) * multiplier)
-                except:
-                    exit("Error parsing input for the following line: \n%s" % line)
-        resarray.append(presarray)
-
-    V = np.asarray(V)
-    return V, resarray, reslist
\ No newline at end of file
+def select_coordinates(atoms, hydrogen, chain=None, backbone=None, weight=1.0):
+    """
+    Select the atoms used in the RMSD, atoms is a dictionary of columns as returned by readAtoms.
+    The selection is done with boolean masks over all the atoms.
+    Backbone atoms are multiplied by weight and the rest by 1 / weight.
+    return coordinates, residue atom counts and residue labels as get_coordinates
+    """
+    atomlist = [b"C", b"N", b"O", b"S", b"P"]
+    if hydrogen:
+        atomlist.append(b"H")
+
+    # if specific chain is specified, only process that chain
+    if chain is not None:
+        inChain = np.isin(atoms['chain'], [c.strip().encode() for c in chain])
+        atoms = {key: values[inChain] for key, values in atoms.items()}
+
+    # residues are runs of consecutive atoms with the same name, chain and number
+    residue = atoms['residue']
+    newRes = np.ones(len(residue), dtype=bool)
+    newRes[1:] = residue[1:] != residue[:-1]
+    resIndex = np.cumsum(newRes) - 1
+    reslist = np.char.add(np.char.add(atoms['chain'][newRes], b':'),
+                          np.char.add(atoms['resSeq'][newRes], atoms['iCode'][newRes])).astype(str).tolist()
+
+    # establish backbone atoms, see if it's a nucleic acid
+    backatoms = [b'CA'] if backbone == 'CA' else [b'N', b'CA', b'C', b'O']
+    nucleicatoms = [b"C3'", b"C4'"] if backbone == 'CA' else \
+        [b"P", b"OP1", b"OP2", b"O3'", b"O5'", b"C3'", b"C4'", b"C5'"]
+    nucleic = np.isin(atoms['resName'], [b'DA', b'DC', b'DG', b'DT', b'DI', b'A', b'C', b'G', b'U', b'I'])
+    isBackbone = np.where(nucleic, np.isin(atoms['name'], nucleicatoms), np.isin(atoms['name'], backatoms))
+
+    # atom type is the first letter of the element
+    selected = np.isin(atoms['element'].astype('S1'), atomlist)
+    if backbone is not None:
+        selected &= isBackbone
+    multiplier = np.where(isBackbone, weight, 1.0 / weight)[selected]
+
+    V = atoms['coords'][selected] * multiplier[:, None]
+    counts = np.bincount(resIndex[selected], minlength=len(reslist))
+    return V, counts, reslist
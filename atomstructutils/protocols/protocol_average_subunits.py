@@ -34,11 +34,73 @@ from pwem.viewers import Chimera
 from pwem.objects import Float, String
 from pyworkflow.protocol.params import (IntParam,
                                         MultiPointerParam,
-                                        PointerParam, FloatParam)
+                                        PointerParam, FloatParam,
+                                        BooleanParam, STEPS_PARALLEL)
 import numpy as np
-from pwem.objects import Volume
+from pwem.objects import Volume, Transform
 
 from pwem.convert.atom_struct import AtomicStructHandler, fromCIFTommCIF
+from .. import Plugin
+from ..convert import (MRC_EXTENSIONS, getMrcFileName, mapMrcData,
+                       createMrcFile, setMrcStatistics, getFileHash,
+                       readCommonCAlphas, getChainCount)
+from ..utils import (getTileSize, iterAveragedTiles, getCacheKey,
+                     loadCachedArrays, saveCachedArrays, kabsch, Envelope,
+                     SharedVolumes,
+                     BYTES_PER_VOXEL, BYTES_PER_VOXEL_SINGLE,
+                     BYTES_PER_VOXEL_EXTRA_MAP)
+
+
+class OutputVolume:
+    """ Volume written tile by tile, either in memory or directly to
+        a MRC file (outOfCore). Keeps the statistics needed by
+        the header"""
+    def __init__(self, fileName, shape, start, sampling, outOfCore):
+        self.fileName = fileName
+        self.start = start  # position of voxel (0,0,0) in the input
+        self.sampling = sampling
+        self.outOfCore = outOfCore
+        if outOfCore:
+            self.data = createMrcFile(fileName, shape, sampling)
+        else:
+            self.data = np.zeros(shape, dtype=np.float32)
+        self.min, self.max = [], []
+        self.sum = self.sum2 = 0.
+        self.count = 0
+
+    def setTile(self, z, y, x, values):
+        if not len(values):
+            return
+        self.data[z - self.start[0], y - self.start[1],
+                  x - self.start[2]] = values
+        self.min.append(values.min())
+        self.max.append(values.max())
+        self.sum += values.sum()
+        self.sum2 += (values ** 2).sum()
+        self.count += len(values)
+
+    def close(self, origin):
+        """ write the volume and set its origin (A)"""
+        if self.outOfCore:
+            self.data.flush()
+            # statistics of the output volume are needed by the viewers
+            # voxels that have not been set are zero
+            nVoxels = self.data.size
+            if nVoxels > self.count:
+                self.min.append(0.)
+                self.max.append(0.)
+            mean = self.sum / nVoxels
+            rms = np.sqrt(max(self.sum2 / nVoxels - mean ** 2, 0.))
+            setMrcStatistics(self.fileName, min(self.min), max(self.max),
+                             mean, rms)
+        else:
+            img = ImageHandler().createImage()
+            img.setData(self.data)
+            img.write(self.fileName)
+        del self.data
+        Ccp4Header.fixFile(self.fileName, self.fileName, tuple(origin),
+                           self.sampling, Ccp4Header.START)
+
 
 class ProtAverageSubunits(EMProtocol):
     """Average densities related with the given atomic structures.
@@ -54,9 +116,33 @@ class ProtAverageSubunits(EMProtocol):
         self.listTransformationMatrices = []
         self.listRMS = []
         self.listObjID = []
-
-    def outputFileName(self):
-        return self._getExtraPath("outPut.mrc")
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    def outputFileName(self, index=0):
+        """ average of the index-th input volume
+            (0 -> inputVolume, i -> i-th of otherVolumes)"""
+        if index == 0:
+            return self._getExtraPath("outPut.mrc")
+        return self._getExtraPath("outPut_%d.mrc" % index)
+
+    def outputStdFileName(self, index=0):
+        if index == 0:
+            return self._getExtraPath("outPutStd.mrc")
+        return self._getExtraPath("outPutStd_%d.mrc" % index)
+
+    def getInputVolumes(self):
+        """ inputVolume followed by otherVolumes"""
+        return [self.inputVolume.get()] + \
+            [pointer.get() for pointer in self.otherVolumes]
+
+    def superpositionFileName(self, index):
+        """ matrix (PDB system) and rms of the superposition
+            of the index-th atom struct onto the reference"""
+        return self._getExtraPath("superposition_%05d.npz" % index)
+
+    def averageFileName(self):
+        """ bounding box and output origin computed by averageStep"""
+        return self._getExtraPath("average.npz")
 
     def _defineParams(self, form):
         form.addSection(label='Input')
@@ -64,6 +150,15 @@ class ProtAverageSubunits(EMProtocol):
                       label='Input Volume', allowsNull=True,
                       important=True,
                       help="Volume to process")
+        form.addParam('otherVolumes', MultiPointerParam,
+                      pointerClass="Volume", allowsNull=True,
+                      label='Other volumes',
+                      help="Other volumes with the same size and sampling "
+                           "than the input volume (e.g. half maps or "
+                           "sharpened maps). They are averaged with the "
+                           "same transformations in the same pass, "
+                           "interpolation indexes and weights are computed "
+                           "only once for all of them.")
         form.addParam('atomStructReference', PointerParam, pointerClass="AtomStruct",
                       label='Atomic Structure 1:', allowsNull=True,
                       important=True,
@@ -87,23 +182,176 @@ class ProtAverageSubunits(EMProtocol):
                       default=3,
                       help="Expand bounding box by this"
                            " number of A.")
+        form.addParam('envelopeRadius', FloatParam, default=0,
+                      label="Envelope radius (A)",
+                      help="If > 0 only the voxels of the bounding box "
+                           "closer than this distance to an atom of the "
+                           "reference atomic structure are averaged, the "
+                           "rest are set to zero. This saves most of the "
+                           "work for elongated or tilted subunits.")
+        form.addParam('batchSuperposition', BooleanParam, default=True,
+                      label="Batched superposition",
+                      help="If set, the alpha carbons common to the "
+                           "reference and each atomic structure are read "
+                           "directly from the files and the superpositions "
+                           "are solved at once (Kabsch algorithm). "
+                           "At least 3 common alpha carbons are needed. "
+                           "Otherwise each "
+                           "atomic structure is superposed to the reference "
+                           "with Biopython, which is slow for large "
+                           "structures or many copies.")
+        form.addParam('useCache', BooleanParam, default=True,
+                      label="Reuse previous superpositions",
+                      help="Transformation matrices between atomic "
+                           "structures are stored in a cache (see "
+                           "ATOMSTRUCTUTILS_CACHE) indexed by the content "
+                           "of the files and the residue range. If set, "
+                           "superpositions already computed are not "
+                           "computed again.")
+        form.addParam('computeStd', BooleanParam, default=False,
+                      label="Compute standard deviation map",
+                      help="Besides the average, compute the standard "
+                           "deviation of each voxel over the subunits. It "
+                           "shows how consistent the subunits are. It is "
+                           "computed in the same pass as the average.")
+        form.addParam('cropOutput', BooleanParam, default=False,
+                      label="Crop output to bounding box",
+                      help="If set, the output volume only contains the "
+                           "bounding box of the reference atomic structure "
+                           "(with the right origin) instead of the whole "
+                           "unit cell, most of it filled with zeros.")
+        group = form.addGroup('Memory')
+        group.addParam('outOfCore', BooleanParam, default=False,
+                       label="Stream volumes from disk",
+                       help="Memory map the input volume (MRC format only) "
+                            "and write the output volume tile by tile "
+                            "instead of loading both volumes in memory. "
+                            "Use it for unit cells that do not fit "
+                            "in RAM.")
+        group.addParam('memoryBudget', FloatParam, default=512,
+                       label="Memory budget (MB)",
+                       help="Maximum amount of memory used by the "
+                            "temporary arrays needed to interpolate "
+                            "a tile of the bounding box. The bounding box "
+                            "is processed in tiles small enough to "
+                            "fit in this budget. It is shared by all "
+                            "the threads.")
+        group.addParam('singlePrecision', BooleanParam, default=False,
+                       label="Single precision",
+                       help="Transform and interpolate in single (float32) "
+                            "instead of double precision. It halves memory "
+                            "and memory traffic. Differences with the double "
+                            "precision result are below 1e-4 times the "
+                            "standard deviation of the input map.")
+        form.addParallelSection(threads=4, mpi=1)
 
     def _insertAllSteps(self):
-        self._insertFunctionStep('createOutput')
-
-    def computeTransformationMatrices(self, origin, sampling):
+        indexes = list(range(len(self.otherAtomStructs)))
+        if self.batchSuperposition:
+            # batched SVDs solve all the superpositions in one step
+            transformIds = [self._insertFunctionStep(
+                'computeTransformationStep', indexes, prerequisites=[])]
+        else:
+            # one (parallel) step per atomic structure
+            transformIds = [self._insertFunctionStep(
+                'computeTransformationStep', [index], prerequisites=[])
+                for index in indexes]
+        averageId = self._insertFunctionStep('averageStep',
+                                             prerequisites=transformIds)
+        self._insertFunctionStep('createOutput', prerequisites=[averageId])
+
+    def computeTransformationStep(self, indexes):
         """ compute transformation matrix between reference
-        atom structure (self.atomStructReference) and the other
-        atom structures (self.otherAtomStructs)
+        atom structure (self.atomStructReference) and the
+        atom structures self.otherAtomStructs[indexes]
          read atomic structures
          identify common AA with first structure
          compute transformation matrix in PDB system
+         matrices and rms are saved in superpositionFileName(index)
+         matrices in PDB system are cached so superpositions
+         are not recomputed if only the map or other parameters change
+        """
+        # reference atom struct
+        atomStructReferenceFn = \
+            self.atomStructReference.get().getFileName()
+        referenceHash = getFileHash(atomStructReferenceFn)
+        cacheDir = Plugin.getCacheDir()
+        # each cached superposition only depends on its pair of structures
+        method = 'kabsch-pair' if self.batchSuperposition else 'biopython'
+        otherAtomStructs = [aStruct for aStruct in self.otherAtomStructs]
+
+        # look for the superpositions in the cache
+        atomStructFns, keys, results = {}, {}, {}
+        for index in indexes:
+            atomStructFn = otherAtomStructs[index].get().getFileName()
+            key = getCacheKey('superposition', method, referenceHash,
+                              getFileHash(atomStructFn),
+                              self.rangeStart.get(), self.rangeEnd.get())
+            cached = loadCachedArrays(cacheDir, key) \
+                if self.useCache else None
+            atomStructFns[index] = atomStructFn
+            keys[index] = key
+            results[index] = None if cached is None else \
+                (cached['matrix'], float(cached['rms']))
+
+        # compute the missing ones
+        missing = [index for index in indexes if results[index] is None]
+        if missing and self.batchSuperposition:
+            # alpha carbons common to the reference and each structure,
+            # pairs with the same number of atoms are solved at once
+            pairs = readCommonCAlphas(
+                atomStructReferenceFn,
+                [atomStructFns[index] for index in missing],
+                self.rangeStart.get(), self.rangeEnd.get())
+            groups = {}
+            for index, (fixed, moving) in zip(missing, pairs):
+                if len(fixed) < 3:
+                    raise Exception(
+                        "Only %d alpha carbons are common to %s and %s, "
+                        "at least 3 are needed to superpose them. Residues "
+                        "are matched by chain order, residue number and "
+                        "insertion code." % (len(fixed), atomStructReferenceFn,
+                                             atomStructFns[index]))
+                groups.setdefault(len(fixed), []).append(index)
+            pairs = dict(zip(missing, pairs))
+            for group in groups.values():
+                matrices, rmsList = kabsch(
+                    [pairs[index][0] for index in group],
+                    [pairs[index][1] for index in group])
+                for index, matrix, rms in zip(group, matrices, rmsList):
+                    results[index] = (matrix, float(rms))
+        elif missing:
+            aStructReferenceHa = AtomicStructHandler(atomStructReferenceFn)
+            for index in missing:
+                results[index] = aStructReferenceHa.getTransformMatrix(
+                    atomStructFns[index], self.rangeStart.get(),
+                    self.rangeEnd.get())
+        if self.useCache:
+            for index in missing:
+                matrix, rms = results[index]
+                saveCachedArrays(cacheDir, keys[index], matrix=matrix,
+                                 rms=rms)
+
+        # persist them so the protocol can be resumed
+        for index in indexes:
+            matrix, rms = results[index]
+            np.savez(self.superpositionFileName(index),
+                     matrix=matrix, rms=rms)
+
+    def averageStep(self):
+        self.computeAveragedSubUnit()
+        np.savez(self.averageFileName(), boundingBoxA=self.boundingBoxA,
+                 outputOrigin=self.outputOrigin)
+
+    def computeTransformationMatrices(self, origin, sampling):
+        """ read the transformation matrices computed by
+        computeTransformationStep (PDB system) and
+        transform them to unitcell system of equations,
+        shifts in px.
          function fills lists
             * listTransformationMatrices
             * listRMS (errors)
             * listObjID (atom structure names)
-         transform matrix to unitcell system of equations
-         shifts in px
         """
         # reference atom struct
         atomStructReferenceFn = \
@@ -112,10 +360,9 @@ class ProtAverageSubunits(EMProtocol):
             atomStructReferenceFn)
 
         # each one of the atom structs different from the reference
-        for aStruct in self.otherAtomStructs:
-            atomStructFn = aStruct.get().getFileName()
-            matrix, rms = self.aStructReferenceHa.getTransformMatrix(
-                atomStructFn, self.rangeStart.get(), self.rangeEnd.get())
+        for index, aStruct in enumerate(self.otherAtomStructs):
+            with np.load(self.superpositionFileName(index)) as data:
+                matrix, rms = data['matrix'], float(data['rms'])
             # getTransformMatrix
             # [[ 9.95590478e-01 -3.44402543e-03 -9.37429380e-02 -5.47417e+01]
             #  [-2.80233170e-03  9.97787836e-01 -6.64197386e-02  2.35492e+01]
@@ -184,10 +431,44 @@ class ProtAverageSubunits(EMProtocol):
         # careful here, index (0,0,) is top left corner
         # relate to PDB coordinates (p) as:
         # are p' = (p - origin)/sampling
-        ih = ImageHandler()
-        img = ih.createImage()
-        img.read(volume.getLocation())
-        matrix = img.getData()  # get matrix with voxels
+        # all the input volumes share the same grid
+        inputVolumes = self.getInputVolumes()
+        numberOfWorkers = max(1, self.numberOfThreads.get())
+        if self.outOfCore:
+            # voxels are read from disk only when needed
+            matrices = [mapMrcData(vol.getFileName())
+                        for vol in inputVolumes]
+        elif numberOfWorkers > 1:
+            # the worker processes read the maps from shared memory,
+            # each map is loaded straight into its block, once
+            matrices = SharedVolumes()
+            for vol in inputVolumes:
+                matrices.append(self.readVolumeData(vol, mapped=True))
+        else:
+            matrices = [self.readVolumeData(vol) for vol in inputVolumes]
+        try:
+            self.averageVolumes(matrices, volume, origin, sampling,
+                                numberOfWorkers)
+        finally:
+            if isinstance(matrices, SharedVolumes):
+                matrices.close()
+
+    def readVolumeData(self, vol, mapped=False):
+        """ voxels of vol (z, y, x). If mapped, MRC files are memory
+            mapped so that the voxels are read when they are copied"""
+        volumeFn = getMrcFileName(vol.getFileName())
+        if mapped and \
+                os.path.splitext(volumeFn)[1].lower() in MRC_EXTENSIONS:
+            return mapMrcData(volumeFn)
+        img = ImageHandler().createImage()
+        img.read(vol.getLocation())
+        return img.getData()  # get matrix with voxels
+
+    def averageVolumes(self, matrices, volume, origin, sampling,
+                       numberOfWorkers):
+        """ average the voxels of the input volumes (matrices, arrays
+            z, y, x) in the bounding box of the reference"""
+        matrix = matrices[0]
         # matrix.shape (220, 274, 455) (z,y,x)
         # scipion reports  455 274 220 (x,y,z)
 
@@ -209,6 +490,10 @@ class ProtAverageSubunits(EMProtocol):
         #  [ -84.15100098   47.80899811  436.43399048    1.        ]]
         # boundingBoxPxOrigin [[103   3  80   1]
         #  [172  74 164   1]]
+        # the expanded bounding box should not go beyond the volume
+        boundingBoxPxOrigin[0, :3] = np.maximum(boundingBoxPxOrigin[0, :3], 0)
+        boundingBoxPxOrigin[1, :3] = np.minimum(boundingBoxPxOrigin[1, :3],
+                                                np.array(matrix.shape[::-1]) - 1)
 
         # 5) loop through points and interpolated
         # grid points to average
@@ -218,108 +503,129 @@ class ProtAverageSubunits(EMProtocol):
         # 00033:    [172  74 164   1]]
 
         # Coords in p' (unit cell system of reference)
-        # this x_, y_, z_ are auxiliary ranges that will be
-        # used to calculate a meshgrid. The purpose of meshgrid is to
-        # create a rectangular grid out of an array of x_, y_ and z_
-        # values.
-        #
-        # So, for example, if we want to create a grid where we have
-        # a point at each integer value between 0 and 4 in x, y and z
-        # directions. To create a rectangular grid, we need every
-        # combination of the x, y and z points.
-        x_ = np.arange(l[0,0], l[1,0]+1, 1); xdim = np.shape(x_)[0]
-        y_ = np.arange(l[0,1], l[1,1]+1, 1); ydim = np.shape(y_)[0]
-        z_ = np.arange(l[0,2], l[1,2]+1, 1); zdim = np.shape(z_)[0]
-        # x_ x_.shape [103 104 105 106] [169 170 171 172] (70,)
-        # y_ y_.shape [3 4 5 6] [71 72 73 74] (72,)
-        # z_ z_.shape [80 81 82 83] [161 162 163 164] (85,)
-        # mesh grid with all the points that need to be evaluated
-
-        coords = np.meshgrid(x_, y_, z_, indexing='ij')
-        # coords coords.shape [array([[[103, 103, 103, ..., 103, 103, 103],
-        #         [103, 103, 103, ..., 103, 103, 103],
-        #         [103, 103, 103, ..., 103, 103, 103],
-        #         ...,
-        #         ...,
-        #         [ 80,  81,  82, ..., 162, 163, 164],
-        #         [ 80,  81,  82, ..., 162, 163, 164],
-        #         [ 80,  81,  82, ..., 162, 163, 164]]])]
-        #  (3, 70, 72, 85)
-
-        # stack the meshgrid to position vectors
-        # meshgrid are several lists with x, y and z coordinates. We want
-        # this values as vectors so we can multiply them by the transformation
-        # matrix
+        # The bounding box is too large to be processed at once
+        # for big unit cells, so it is split in tiles of consecutive
+        # voxels that may be processed in parallel.
         # Since I use generalized coordinates, vectors should have
         # 4 dimensions and the
         # last dimension should be always 1 (integer 1!!).
-        xyz=np.vstack([coords[0].reshape(-1),
-                       coords[1].reshape(-1),
-                       coords[2].reshape(-1),
-                       np.ones((xdim, ydim, zdim), dtype=int).reshape(-1)])
-        #xyz xyz.shape [[103. 103. 103. ... 172. 172. 172.]
+        # xyz xyz.shape [[103. 103. 103. ... 172. 172. 172.]
         # [  3.   3.   3. ...  74.  74.  74.]
         # [ 80.  81.  82. ... 162. 163. 164.]
         # [  1.   1.   1. ...   1.   1.   1.]] (4, 428400=  70 *  72 * 85)
+        boxStart = l[0, 2::-1]  # z, y, x
+        boxShape = l[1, 2::-1] - boxStart + 1
+
         # let us create a volume with the same size than the input volume
-        # to store the output
-        outmatrix = np.zeros_like(matrix)
-
-        # I can not use xyz as indexes for numpy since xys is in
-        # generalized coordiantes
-        x = xyz[0, :]
-        y = xyz[1, :]
-        z = xyz[2, :]
-        # copy bounding box region to output volume
-        # note that
-        outmatrix[z,y,x] = matrix[z,y,x]
-
-        # now copy the region related by the transformation matrices
-        # interpolating the points if needed
-        for counter, transformationMatrix in enumerate(self.listTransformationMatrices):
-            transformed_xyz = transformationMatrix @ xyz
-            # transformationMatrix
-            # [[ 9.95590478e-01 -2.80233170e-03  9.37643145e-02  3.96147e+01]
-            #  [-3.44402543e-03  9.97787836e-01  6.63895581e-02 -1.77753e+01]
-            #  [-9.37429380e-02 -6.64197386e-02  9.93378417e-01 -8.00067e+00]
-            #  [ 0.00000000e+00  0.00000000e+00  0.00000000e+00  7.35294e-01]]
-            # transformed_xyz transformed_xyz.shape
-            # [[165.42162908 165.51539339 165.60915771 ... 241.60708031 241.70084462
-            # 00183:     241.79460894]
-            # 00184:    [  1.42342186   1.48981142   1.55620098 ...  77.47266421  77.53905377
-            # 00185:      77.60544333]
-            # 00186:    [ 85.10806994  86.10144836  87.09482677 ... 155.38103599 156.37441441
-            # 00187:     157.36779283]
-            # 00188:    [  1.           1.           1.         ...   1.           1.
-            # 00189:       1.        ]] (4, 428400)
-
-            # matrix(xp, yp and zp) should be averaged with matrix(x,y,z)
-            xp = transformed_xyz[0, :]
-            yp = transformed_xyz[1, :]
-            zp = transformed_xyz[2, :]
-            outmatrix[z,y,x] += self.trilinearInterpolation(xp, yp, zp, matrix)
+        # (or the bounding box if cropped) to store the output.
+        # If out of core it lives on disk and
+        # tiles are written as soon as they are computed
+        origin = np.array(volume.getOrigin(force=True).getShifts())
+        if self.cropOutput:
+            outShape = tuple(boxShape)
+            # voxel (0,0,0) of the output is voxel l[0] of the input
+            outStart = boxStart
+            origin += l[0, :3] * sampling
+        else:
+            outShape = matrix.shape
+            outStart = np.zeros(3, dtype=int)
+        self.outputOrigin = origin  # needed to create the output volume
+        outVolumes = [OutputVolume(self.outputFileName(index), outShape,
+                                   outStart, sampling, self.outOfCore.get())
+                      for index in range(len(matrices))]
+        stdVolumes = [OutputVolume(self.outputStdFileName(index), outShape,
+                                   outStart, sampling, self.outOfCore.get())
+                      for index in range(len(matrices))] \
+            if self.computeStd else None
 
         # divide sum by the number averaged regions
         factor = len(self.listTransformationMatrices) + 1.
-        outmatrix /= factor
-        img.setData(outmatrix)
-        kkFn = self.outputFileName()
-        img.write(kkFn)
-        origin = volume.getOrigin(force=True).getShifts()
-        Ccp4Header.fixFile(kkFn, kkFn, origin, sampling,
-                           Ccp4Header.START)
+        # each worker process gets its share of the memory budget
+        if self.singlePrecision:
+            dtype, bytesPerVoxel = np.float32, BYTES_PER_VOXEL_SINGLE
+        else:
+            dtype, bytesPerVoxel = np.float64, BYTES_PER_VOXEL
+        bytesPerVoxel += (len(matrices) - 1) * BYTES_PER_VOXEL_EXTRA_MAP
+        tileSize = getTileSize(self.memoryBudget.get() / numberOfWorkers,
+                               bytesPerVoxel)
+        # voxels close to the atoms of the reference (pixels, unit cell)
+        # voxels outside the bounding box (or the envelope) are zero
+        envelope = None
+        if self.envelopeRadius.get() > 0:
+            atoms = np.array([atom.get_coord() for atom in
+                              self.aStructReferenceHa.getStructure()[0].
+                             get_atoms()])
+            atomsPx = (convert[:3, :3] @ atoms.T).T + convert[:3, 3]
+            envelope = Envelope(atomsPx,
+                                self.envelopeRadius.get() / sampling)
+        # For each tile we get the x, y and z coordinates of its voxels
+        # and the sum of the voxel values and the region related by the
+        # transformation matrices (interpolating the points if needed).
+        # transformationMatrix
+        # [[ 9.95590478e-01 -2.80233170e-03  9.37643145e-02  3.96147e+01]
+        #  [-3.44402543e-03  9.97787836e-01  6.63895581e-02 -1.77753e+01]
+        #  [-9.37429380e-02 -6.64197386e-02  9.93378417e-01 -8.00067e+00]
+        #  [ 0.00000000e+00  0.00000000e+00  0.00000000e+00  7.35294e-01]]
+        # transformed_xyz transformed_xyz.shape
+        # [[165.42162908 165.51539339 165.60915771 ... 241.79460894]
+        #  [  1.42342186   1.48981142   1.55620098 ...  77.60544333]
+        #  [ 85.10806994  86.10144836  87.09482677 ... 157.36779283]
+        #  [  1.           1.           1.         ...   1.        ]]
+        # matrix(transformed_xyz) should be averaged with matrix(x,y,z)
+        # The sum of squared deviations from the mean (deviations) is
+        # accumulated in the same pass (Welford), variance = M2 / factor
+        # Indexes and weights of the interpolation are shared by all the
+        # input volumes, each extra volume only adds a gather
+        mrcFileNames = [vol.getFileName() for vol in self.getInputVolumes()] \
+            if self.outOfCore else None
+        for z, y, x, tiles, deviations in iterAveragedTiles(
+                matrices, boxStart, boxShape, self.listTransformationMatrices,
+                tileSize, numberOfWorkers=numberOfWorkers,
+                mrcFileNames=mrcFileNames, envelope=envelope,
+                withDeviations=stdVolumes is not None, dtype=dtype):
+            for index, outVolume in enumerate(outVolumes):
+                outVolume.setTile(z, y, x, tiles[index] / factor)
+                if stdVolumes is not None:
+                    stdVolumes[index].setTile(
+                        z, y, x, np.sqrt(deviations[index] / factor))
+
+        for outVolume in outVolumes + (stdVolumes or []):
+            outVolume.close(origin)
 
     def createOutput(self):
-        self.computeAveragedSubUnit()
+        # results of averageStep
+        with np.load(self.averageFileName()) as data:
+            self.boundingBoxA = data['boundingBoxA']
+            outputOrigin = data['outputOrigin']
         # save results
         inVol = self.inputVolume.get()
         outVol = Volume()
-        origin = inVol.getOrigin(force=True)
+        origin = Transform()
+        origin.setShifts(*outputOrigin)
         sampling = inVol.getSamplingRate()
         outVol.setSamplingRate(sampling)
         outVol.setOrigin(origin)
         outVol.setFileName(self.outputFileName())
         self._defineOutputs(outVol=outVol)
+        if self.computeStd:
+            outVolStd = Volume()
+            outVolStd.setSamplingRate(sampling)
+            outVolStd.setOrigin(origin)
+            outVolStd.setFileName(self.outputStdFileName())
+            self._defineOutputs(outVolStd=outVolStd)
+        # averages of the other volumes, outVol_1, outVol_2...
+        for index in range(1, len(self.otherVolumes) + 1):
+            otherVol = Volume()
+            otherVol.setSamplingRate(sampling)
+            otherVol.setOrigin(origin)
+            otherVol.setFileName(self.outputFileName(index))
+            self._defineOutputs(**{'outVol_%d' % index: otherVol})
+            if self.computeStd:
+                otherVolStd = Volume()
+                otherVolStd.setSamplingRate(sampling)
+                otherVolStd.setOrigin(origin)
+                otherVolStd.setFileName(self.outputStdFileName(index))
+                self._defineOutputs(**{'outVolStd_%d' % index: otherVolStd})
         with open("chimera_output.cxc", 'w') as f:
             dim = 150.
             bildFileName = os.path.abspath(self._getExtraPath(
@@ -368,64 +674,46 @@ class ProtAverageSubunits(EMProtocol):
 
     def _validate(self):
         errors = []
+        inputVolumes = self.getInputVolumes()
+        if self.outOfCore:
+            for vol in inputVolumes:
+                volumeFn = getMrcFileName(vol.getFileName())
+                if os.path.splitext(volumeFn)[1].lower() \
+                        not in MRC_EXTENSIONS:
+                    errors.append("Streaming from disk requires MRC input "
+                                  "volumes, %s is not" % volumeFn)
+        # other volumes are interpolated on the grid of the input volume
+        inputVol = inputVolumes[0]
+        for vol in inputVolumes[1:]:
+            if vol.getDim() != inputVol.getDim() or \
+                    vol.getSamplingRate() != inputVol.getSamplingRate():
+                errors.append("Volume %s does not have the size and "
+                              "sampling of the input volume" %
+                              vol.getFileName())
         # check number of chains in each entry
+        # only the chain column is read, so this is fast
+        # even for very large atomic structures
         atomStructReferenceFn = self.atomStructReference.get().getFileName()
-        aStructReferenceHa = AtomicStructHandler(atomStructReferenceFn)
-        listOfChains, listOfResidues = \
-            aStructReferenceHa.getModelsChains()
+        numberOfChains = getChainCount(atomStructReferenceFn)
 
         for aStruct in self.otherAtomStructs:
             atomStructFn = aStruct.get().getFileName()
-            aStructReferenceHa = AtomicStructHandler(atomStructFn)
-            listOfChains2, listOfResidues2 = \
-                aStructReferenceHa.getModelsChains()
-            if len(listOfChains[0]) != len(listOfChains2[0]):
+            numberOfChains2 = getChainCount(atomStructFn)
+            if numberOfChains != numberOfChains2:
                 errors.append("Number of chains in reference atomic struct"
                               " and atomic struct called %s is differente"
-                              " %d != %d" % (atomStructFn, len(listOfChains[0]),
-                                             len(listOfChains2[0])))
+                              " %d != %d" % (atomStructFn, numberOfChains,
+                                             numberOfChains2))
         return errors
 
-    def trilinearInterpolation(self, xf, yf, zf, input_array):
-        """ Interpolates the value of point "indices" in matrix
-            input_array.
-            return the interpolated value
-        """
-        #output = np.empty(indices[0].shape)
-        #x_indices = indices[0]
-        #y_indices = indices[1]
-        #z_indices = indices[2]
-
-        x0 = xf.astype(np.integer)
-        y0 = yf.astype(np.integer)
-        z0 = zf.astype(np.integer)
-        x1 = x0 + 1
-        y1 = y0 + 1
-        z1 = z0 + 1
-
-        # Check if xyz1 is beyond array boundary:
-        x1[np.where(x1 == input_array.shape[0])] = x0.max()
-        y1[np.where(y1 == input_array.shape[1])] = y0.max()
-        z1[np.where(z1 == input_array.shape[2])] = z0.max()
-
-        x = xf - x0
-        y = yf - y0
-        z = zf - z0
-        output = (input_array[z0, y0, x0] * (1 - x) * (1 - y) * (1 - z) +
-                  input_array[z1, y0, x0] * x * (1 - y) * (1 - z) +
-                  input_array[z0, y1, x0] * (1 - x) * y * (1 - z) +
-                  input_array[z0, y0, x1] * (1 - x) * (1 - y) * z +
-                  input_array[z1, y0, x1] * x * (1 - y) * z +
-                  input_array[z0, y1, x1] * (1 - x) * y * z +
-                  input_array[z1, y1, x0] * x * y * (1 - z) +
-                  input_array[z1, y1, x1] * x * y * z)
-
-        return output
-
     def _summary(self):
         summary = []
-        for rms, objId in zip(self.listRMS, self.listObjID):
-            summary.append("Obj: %d has rms %d", objId, rms)
+        for index, aStruct in enumerate(self.otherAtomStructs):
+            superpositionFn = self.superpositionFileName(index)
+            if os.path.exists(superpositionFn):
+                with np.load(superpositionFn) as data:
+                    summary.append("Obj: %s has rms %0.3f" %
+                                   (aStruct.getNameId(), float(data['rms'])))
         return summary
 
     def _citations(self):
@@ -21,9 +21,15 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # ***************************************************************************/
 
+import os
+import re
+import numpy as np
 from atomstructutils.protocols import ProtRMSDAtomStructs
+from atomstructutils.protocols.protocol_atomStructs_rmsd import (RMSD_PAIR_STEPS, RMSD_ALL_PAIRS,
+                                                                 RMSD_REFERENCE, RMSD_SAMPLED,
+                                                                 INPUT_MODELS)
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
-from pwem.protocols.protocol_import import ProtImportSetOfAtomStructs
+from pwem.protocols.protocol_import import ProtImportSetOfAtomStructs, ProtImportPdb
 
 
 class TestImportBase(BaseTest):
@@ -33,17 +39,27 @@ class TestImportBase(BaseTest):
       cls.ds = DataSet.getDataSet('model_building_tutorial')
 
     @classmethod
-    def _importStructurePDBSet(cls):
+    def _importStructurePDBSet(cls, pattern='1ake_*.pdb'):
         args = {'inputPdbData': ProtImportSetOfAtomStructs.IMPORT_FROM_FILES,
                 'filesPath': cls.ds.getFile('PDBx_mmCIF'),
-                'filesPattern': cls.ds.getFile('PDBx_mmCIF/1ake_*.pdb')
+                'filesPattern': cls.ds.getFile('PDBx_mmCIF/%s' % pattern)
                 }
         protImportPDBs = cls.newProtocol(ProtImportSetOfAtomStructs, **args)
-        protImportPDBs.setObjLabel('import 1akes structures\n')
+        protImportPDBs.setObjLabel('import %s structures\n' % pattern)
         cls.launchProtocol(protImportPDBs)
 
         return getattr(protImportPDBs, protImportPDBs._OUTNAME)
 
+    @classmethod
+    def _importStructurePDB(cls, pdbID):
+        args = {'inputPdbData': ProtImportPdb.IMPORT_FROM_ID,
+                'pdbId': pdbID
+                }
+        protImportPDB = cls.newProtocol(ProtImportPdb, **args)
+        protImportPDB.setObjLabel('import structure\n %s' % pdbID)
+        cls.launchProtocol(protImportPDB)
+        return protImportPDB.outputPdb
+
 class TestRMSD(TestImportBase):
 
     def testRMSD(self):
@@ -57,3 +73,120 @@ class TestRMSD(TestImportBase):
         protRMSDAll = self.newProtocol(ProtRMSDAtomStructs, **args)
         protRMSDAll.setObjLabel('RMSD for all atoms')
         self.launchProtocol(protRMSDAll)
+
+    def testRMSDVectorized(self):
+        """One step per pair and vectorized computation should agree"""
+        inputASs = self._importStructurePDBSet()
+        overallRMSDs = []
+        for rmsdMode in [RMSD_PAIR_STEPS, RMSD_ALL_PAIRS]:
+            args = {'inputStructureSet': inputASs,
+                    'chains': '',
+                    'considerAtoms': 0,
+                    'rmsdMode': rmsdMode,
+                    'useCache': False,
+                    }
+            protRMSD = self.newProtocol(ProtRMSDAtomStructs, **args)
+            protRMSD.setObjLabel('RMSD CA mode %d' % rmsdMode)
+            self.launchProtocol(protRMSD)
+            outSet = getattr(protRMSD, protRMSD._OUTNAME)
+            overallRMSDs.append(float(outSet.overallRMSD))
+        self.assertAlmostEqual(overallRMSDs[0], overallRMSDs[1], places=4)
+
+    def testRMSDSampled(self):
+        """If maxPairs covers all the pairs, sampling compares all of them and
+        the estimate is the all pairs RMSD"""
+        inputASs = self._importStructurePDBSet()
+        outSets = []
+        for rmsdMode in [RMSD_ALL_PAIRS, RMSD_SAMPLED]:
+            args = {'inputStructureSet': inputASs,
+                    'chains': '',
+                    'considerAtoms': 0,
+                    'rmsdMode': rmsdMode,
+                    'targetPrecision': 0.05,
+                    }
+            protRMSD = self.newProtocol(ProtRMSDAtomStructs, **args)
+            protRMSD.setObjLabel('RMSD CA mode %d' % rmsdMode)
+            self.launchProtocol(protRMSD)
+            outSets.append(getattr(protRMSD, protRMSD._OUTNAME))
+        allPairs, sampled = outSets
+        self.assertAlmostEqual(float(allPairs.overallRMSD), float(sampled.overallRMSD), places=4)
+        self.assertAlmostEqual(float(sampled.overallRMSDci95), 0., places=6)
+
+    def testRMSDReference(self):
+        """Each structure compared with a reference file or with the mean structure"""
+        inputASs = self._importStructurePDBSet()
+        args = {'inputPdbData': ProtImportPdb.IMPORT_FROM_FILES,
+                'pdbFile': self.ds.getFile('PDBx_mmCIF/1ake_start.pdb')
+                }
+        protImportPDB = self.newProtocol(ProtImportPdb, **args)
+        protImportPDB.setObjLabel('import reference\n 1ake_start')
+        self.launchProtocol(protImportPDB)
+        for reference in [protImportPDB.outputPdb, None]:
+            args = {'inputStructureSet': inputASs,
+                    'chains': '',
+                    'considerAtoms': 0,
+                    'rmsdMode': RMSD_REFERENCE,
+                    'referenceStructure': reference,
+                    'useCache': False,
+                    }
+            protRMSD = self.newProtocol(ProtRMSDAtomStructs, **args)
+            protRMSD.setObjLabel('RMSD CA to %s' % ('1ake_start' if reference else 'mean structure'))
+            self.launchProtocol(protRMSD)
+            overall = float(getattr(protRMSD, protRMSD._OUTNAME).overallRMSD)
+            self.assertTrue(np.isfinite(overall))
+            self.assertGreater(overall, 0)
+
+    def testRMSDSuperposed(self):
+        """Superposed pairs can not deviate more than in the deposited frame"""
+        inputASs = self._importStructurePDBSet()
+        overallRMSDs = []
+        for superpose in [False, True]:
+            args = {'inputStructureSet': inputASs,
+                    'chains': '',
+                    'considerAtoms': 0,
+                    'superpose': superpose,
+                    'useCache': False,
+                    }
+            protRMSD = self.newProtocol(ProtRMSDAtomStructs, **args)
+            protRMSD.setObjLabel('RMSD CA superpose=%s' % superpose)
+            self.launchProtocol(protRMSD)
+            outSet = getattr(protRMSD, protRMSD._OUTNAME)
+            overallRMSDs.append(float(outSet.overallRMSD))
+        self.assertLessEqual(overallRMSDs[1], overallRMSDs[0] + 1e-4)
+
+    def testRMSDCache(self):
+        """Pairs computed for a subset are reused when the whole set is compared"""
+        subset = self._importStructurePDBSet('1ake_mut*.pdb')
+        inputASs = self._importStructurePDBSet()
+        reused = []
+        for structures in [subset, inputASs]:
+            args = {'inputStructureSet': structures,
+                    'chains': '',
+                    'considerAtoms': 0,
+                    'rmsdMode': RMSD_ALL_PAIRS,
+                    'useCache': True,
+                    }
+            protRMSD = self.newProtocol(ProtRMSDAtomStructs, **args)
+            protRMSD.setObjLabel('RMSD CA cached, %d structures' % len(structures))
+            self.launchProtocol(protRMSD)
+            with open(protRMSD.getLogPaths()[0]) as f:
+                reused.append(int(re.search(r'RMSD computed for \d+ pairs of structures, (\d+) reused',
+                                            f.read()).group(1)))
+        m = len(subset)
+        self.assertGreaterEqual(reused[1], m * (m - 1) // 2)
+
+    def testRMSDMultiModel(self):
+        """Models of a NMR ensemble (ubiquitin, 10 models) in a single file"""
+        inputAS = self._importStructurePDB('1d3z')
+        args = {'inputType': INPUT_MODELS,
+                'inputStructure': inputAS,
+                'rmsdMode': RMSD_ALL_PAIRS,
+                'chains': '',
+                'considerAtoms': 0,
+                }
+        protRMSD = self.newProtocol(ProtRMSDAtomStructs, **args)
+        protRMSD.setObjLabel('RMSD CA multi-model')
+        self.launchProtocol(protRMSD)
+        outAS = getattr(protRMSD, protRMSD._OUTNAME_MODELS)
+        self.assertTrue(os.path.exists(outAS.getFileName()))
+        self.assertGreater(float(outAS.overallRMSD), 0)
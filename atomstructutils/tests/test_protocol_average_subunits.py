@@ -24,11 +24,17 @@
 
 # protocol to test the operation on PDB files
 import os
+import numpy as np
 from atomstructutils.protocols import ProtAtomStrucOperate, ProtAverageSubunits
 from pyworkflow.tests import BaseTest, setupTestProject
 from pwem.protocols.protocol_import import ProtImportPdb
 from pwem.protocols.protocol_import.volumes import ProtImportVolumes
 import pwem.protocols as emprot
+from pwem.emlib.image import ImageHandler
+from pwem.convert import Ccp4Header
+from pwem.convert.atom_struct import AtomicStructHandler
+from atomstructutils.utils import SINGLE_PRECISION_TOLERANCE, Envelope
+from atomstructutils.convert import readMrcStatistics
 from xmipp3.protocols import XmippProtExtractUnit
 from xmipp3.constants import (XMIPP_I222r)
 
@@ -210,3 +216,195 @@ class TestAverageSubUnit(TestImportBase):
         # let us check that there is an exit file
         result= protAverageSubunits.outVol.getFileName()
         self.assertTrue(os.path.exists(result))
+
+    def testAverageSubUnitCropped(self):
+        """Call protocol with four hexons and crop the output
+        to the bounding box of the reference"""
+        args = {'inputVolume': self.unitcell,
+                'atomStructReference': self.h1,
+                'otherAtomStructs': [self.h2, self.h3, self.h4],
+                'rangeStart': -1,
+                'rangeEnd': -1,
+                'cropOutput': True,
+                }
+
+        protAverageSubunits = self.newProtocol(ProtAverageSubunits, **args)
+        protAverageSubunits.setObjLabel('Four hexons\ncropped')
+        self.launchProtocol(protAverageSubunits)
+
+        # the cropped volume should be smaller than the unit cell
+        outVol = protAverageSubunits.outVol
+        self.assertTrue(os.path.exists(outVol.getFileName()))
+        for outDim, inDim in zip(outVol.getDim(), self.unitcell.getDim()):
+            self.assertLessEqual(outDim, inDim)
+
+    def testAverageSubUnitSinglePrecision(self):
+        """Single and double precision averages (and standard
+        deviations) should agree within the documented tolerance"""
+        outputs = {}
+        for singlePrecision in [False, True]:
+            args = {'inputVolume': self.unitcell,
+                    'atomStructReference': self.h1,
+                    'otherAtomStructs': [self.h2, self.h3, self.h4],
+                    'rangeStart': -1,
+                    'rangeEnd': -1,
+                    'cropOutput': True,
+                    'computeStd': True,
+                    'singlePrecision': singlePrecision,
+                    }
+            protAverageSubunits = self.newProtocol(ProtAverageSubunits,
+                                                   **args)
+            protAverageSubunits.setObjLabel('Four hexons\nsingle precision=%s'
+                                            % singlePrecision)
+            self.launchProtocol(protAverageSubunits)
+            outputs[singlePrecision] = \
+                [ImageHandler().read(vol).getData() for vol in
+                 [protAverageSubunits.outVol, protAverageSubunits.outVolStd]]
+
+        inputStd = ImageHandler().read(self.unitcell).getData().std()
+        for double, single in zip(outputs[False], outputs[True]):
+            self.assertLessEqual(abs(double - single).max(),
+                                 SINGLE_PRECISION_TOLERANCE * inputStd)
+
+    def testAverageSubUnitOtherVolumes(self):
+        """Other volumes are averaged with the same transformations,
+        the average of a copy of the input volume should be identical"""
+        args = {'inputVolume': self.unitcell,
+                'otherVolumes': [self.unitcell],
+                'atomStructReference': self.h1,
+                'otherAtomStructs': [self.h2, self.h3, self.h4],
+                'rangeStart': -1,
+                'rangeEnd': -1,
+                'cropOutput': True,
+                }
+        protAverageSubunits = self.newProtocol(ProtAverageSubunits, **args)
+        protAverageSubunits.setObjLabel('Four hexons\ntwo volumes')
+        self.launchProtocol(protAverageSubunits)
+
+        average = ImageHandler().read(protAverageSubunits.outVol).getData()
+        otherAverage = ImageHandler().read(
+            getattr(protAverageSubunits, 'outVol_1')).getData()
+        self.assertTrue((average == otherAverage).all())
+
+    def testAverageSubUnitOutOfCore(self):
+        """Streaming the volumes from disk should give the same output
+        (data, header statistics and origin) than averaging in memory"""
+        outputs = {}
+        for outOfCore in [False, True]:
+            args = {'inputVolume': self.unitcell,
+                    'atomStructReference': self.h1,
+                    'otherAtomStructs': [self.h2, self.h3, self.h4],
+                    'rangeStart': -1,
+                    'rangeEnd': -1,
+                    'outOfCore': outOfCore,
+                    }
+            protAverageSubunits = self.newProtocol(ProtAverageSubunits, **args)
+            protAverageSubunits.setObjLabel('Four hexons\nout of core=%s'
+                                            % outOfCore)
+            self.launchProtocol(protAverageSubunits)
+            outVol = protAverageSubunits.outVol
+            outputs[outOfCore] = (
+                ImageHandler().read(outVol).getData(),
+                readMrcStatistics(outVol.getFileName()),
+                Ccp4Header(outVol.getFileName(), readHeader=True).getOrigin())
+
+        inMemory, streamed = outputs[False], outputs[True]
+        self.assertTrue(np.allclose(inMemory[0], streamed[0]))
+        # statistics are accumulated tile by tile in the streamed output
+        self.assertTrue(np.allclose(inMemory[1], streamed[1], rtol=1e-4,
+                                    atol=1e-6))
+        self.assertTrue(np.allclose(inMemory[2], streamed[2]))
+
+    def testAverageSubUnitThreads(self):
+        """Averaging the tiles in several processes should give the same
+        output than the serial path"""
+        outputs = {}
+        for numberOfThreads in [1, 4]:
+            args = {'inputVolume': self.unitcell,
+                    'atomStructReference': self.h1,
+                    'otherAtomStructs': [self.h2, self.h3, self.h4],
+                    'rangeStart': -1,
+                    'rangeEnd': -1,
+                    'memoryBudget': 16,  # several tiles per thread
+                    'numberOfThreads': numberOfThreads,
+                    }
+            protAverageSubunits = self.newProtocol(ProtAverageSubunits, **args)
+            protAverageSubunits.setObjLabel('Four hexons\nthreads=%d'
+                                            % numberOfThreads)
+            self.launchProtocol(protAverageSubunits)
+            outputs[numberOfThreads] = ImageHandler().read(
+                protAverageSubunits.outVol).getData()
+
+        self.assertTrue(np.allclose(outputs[1], outputs[4]))
+
+    def testAverageSubUnitBatchSuperposition(self):
+        """The batched Kabsch superposition should give the same
+        transformations than Biopython"""
+        superpositions = {}
+        for batchSuperposition in [True, False]:
+            args = {'inputVolume': self.unitcell,
+                    'atomStructReference': self.h1,
+                    'otherAtomStructs': [self.h2, self.h3, self.h4],
+                    'rangeStart': -1,
+                    'rangeEnd': -1,
+                    'batchSuperposition': batchSuperposition,
+                    'useCache': False,
+                    }
+            protAverageSubunits = self.newProtocol(ProtAverageSubunits, **args)
+            protAverageSubunits.setObjLabel('Four hexons\nbatched=%s'
+                                            % batchSuperposition)
+            self.launchProtocol(protAverageSubunits)
+            superpositions[batchSuperposition] = []
+            for index in range(3):
+                with np.load(protAverageSubunits.superpositionFileName(
+                        index)) as data:
+                    superpositions[batchSuperposition].append(
+                        (data['matrix'], float(data['rms'])))
+
+        for (batchMatrix, batchRms), (matrix, rms) in zip(
+                superpositions[True], superpositions[False]):
+            self.assertTrue(np.allclose(batchMatrix, matrix, atol=1e-3))
+            self.assertAlmostEqual(batchRms, rms, places=3)
+
+    def testAverageSubUnitEnvelope(self):
+        """Voxels inside the envelope of the reference should have the
+        same value than without envelope, the ones outside should be 0"""
+        outputs = {}
+        for envelopeRadius in [0., 5.]:
+            args = {'inputVolume': self.unitcell,
+                    'atomStructReference': self.h1,
+                    'otherAtomStructs': [self.h2, self.h3, self.h4],
+                    'rangeStart': -1,
+                    'rangeEnd': -1,
+                    'envelopeRadius': envelopeRadius,
+                    'cropOutput': True,
+                    }
+            protAverageSubunits = self.newProtocol(ProtAverageSubunits, **args)
+            protAverageSubunits.setObjLabel('Four hexons\nenvelope=%.1f'
+                                            % envelopeRadius)
+            self.launchProtocol(protAverageSubunits)
+            outputs[envelopeRadius] = ImageHandler().read(
+                protAverageSubunits.outVol).getData()
+
+        # voxels of the cropped output inside the envelope, the box
+        # starts at the bounding box of the reference (see averageStep)
+        sampling = self.unitcell.getSamplingRate()
+        origin = np.ones(4)
+        origin[:3] = self.unitcell.getShiftsFromOrigin()
+        convert = protAverageSubunits.convertAtomicModel2UnitCellMatrix(
+            sampling, origin)
+        with np.load(protAverageSubunits.averageFileName()) as data:
+            boxStart = np.maximum(
+                (convert @ data['boundingBoxA'][0]).astype(int)[:3], 0)
+        atoms = np.array([atom.get_coord() for atom in AtomicStructHandler(
+            self.h1.getFileName()).getStructure()[0].get_atoms()])
+        atomsPx = (convert[:3, :3] @ atoms.T).T + convert[:3, 3]
+        envelope = Envelope(atomsPx, 5. / sampling)
+        enveloped, unmasked = outputs[5.], outputs[0.]
+        z, y, x = np.indices(enveloped.shape).reshape(3, -1)
+        inside = envelope.contains(x + boxStart[0], y + boxStart[1],
+                                   z + boxStart[2]).reshape(enveloped.shape)
+
+        self.assertTrue(inside.any() and not inside.all())
+        self.assertTrue(np.allclose(enveloped[inside], unmasked[inside]))
+        self.assertTrue(np.all(enveloped[~inside] == 0))
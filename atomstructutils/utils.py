@@ -0,0 +1,774 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *              Marta Martinez (mmmtnez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Numerical helpers shared by the protocols of this plugin.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.spatial import cKDTree
+
+# approximated number of bytes of temporary arrays needed to
+# average a single voxel: coordinates of the voxel plus the buffers
+# of interpolateTransformedSum (transformed coordinates, indexes
+# and weights) for one interpolated point
+BYTES_PER_VOXEL = 320
+# same in single precision, indexes are still 64 bits
+BYTES_PER_VOXEL_SINGLE = 224
+# additional bytes per voxel for each extra map averaged in the same
+# pass (value and sum buffers, output tile and deviations)
+BYTES_PER_VOXEL_EXTRA_MAP = 32
+# maximum difference between single and double precision averages
+# (and standard deviations), relative to the standard deviation of
+# the input map. Measured for unit cells up to 1000 px
+SINGLE_PRECISION_TOLERANCE = 1e-4
+# default number of interpolated points processed at once
+CHUNK_SIZE = 2 ** 20
+# tiles submitted to each averaging worker process and not consumed yet,
+# it bounds the finished tiles waiting in the parent process
+TILES_IN_FLIGHT_PER_WORKER = 2
+
+
+def getCacheKey(*items):
+    """ Key of a cached result computed from items (file hashes,
+        parameters...)"""
+    return hashlib.sha256(repr(items).encode()).hexdigest()
+
+
+def loadCachedArrays(cacheDir, key):
+    """ return the dictionary of arrays stored with saveCachedArrays
+        or None if key is not in the cache"""
+    fileName = os.path.join(cacheDir, key[:2], key + '.npz')
+    try:
+        with np.load(fileName) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        return None
+
+
+def saveCachedArrays(cacheDir, key, **arrays):
+    """ Store arrays in the cache. The file is written under a temporary
+        name and then renamed so concurrent readers never see it
+        half written"""
+    dirName = os.path.join(cacheDir, key[:2])
+    os.makedirs(dirName, exist_ok=True)
+    fd, tmpName = tempfile.mkstemp(dir=dirName, suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmpName, os.path.join(dirName, key + '.npz'))
+
+
+class PairCache:
+    """ Results of pairs of structures (e.g. RMSDs) stored in the cache
+        under key (the parameters they depend on). A pair is identified
+        by the hashes of both structures, in any order. All the pairs of
+        a structure (the one with the smallest hash) are kept in a single
+        file, so the cache grows with the number of structures and a run
+        opens each file once, instead of one file per pair.
+        Arrays are read and written in place, one row per pair:
+        rows[n] is the row of arrays with the results of pairs[n]
+        (None -> row n)
+    """
+    def __init__(self, cacheDir, key):
+        self.dirName = os.path.join(cacheDir, 'pairs', key)
+
+    def getFileName(self, owner):
+        # subdirectory from a hash of the name: owners may share a
+        # prefix (e.g. models of the same file, fileHash:i)
+        name = owner.replace(':', '_')
+        subDir = hashlib.sha256(name.encode()).hexdigest()[:2]
+        return os.path.join(self.dirName, subDir, name + '.npz')
+
+    def load(self, pairs, rows=None, **arrays):
+        """ fill the rows of arrays with the cached results of pairs
+            return the positions in pairs of the ones found"""
+        found = []
+        for owner, members in self._group(pairs).items():
+            data = self._read(owner)
+            if data is None:
+                continue
+            partners = {partner: k for k, partner in
+                        enumerate(data['partners'].tolist())}
+            for n, partner in members:
+                if partner not in partners:
+                    continue
+                found.append(n)
+                row = n if rows is None else rows[n]
+                for name, values in arrays.items():
+                    values[row] = data[name][partners[partner]]
+        return sorted(found)
+
+    def save(self, pairs, rows=None, **arrays):
+        """ store the rows of arrays as the results of pairs. Results
+            of other pairs in the same files are kept. Files are
+            replaced atomically, if two runs update the same file at
+            once the rows of one of them are lost (and computed again
+            next time), never corrupted"""
+        for owner, members in self._group(pairs).items():
+            partners = [partner for _, partner in members]
+            rowList = [n if rows is None else rows[n] for n, _ in members]
+            new = {name: np.asarray(values)[rowList]
+                   for name, values in arrays.items()}
+            old = self._read(owner)
+            if old is not None and set(old) == set(new) | {'partners'} and \
+                    all(old[name].shape[1:] == new[name].shape[1:]
+                        for name in new):
+                keep = ~np.isin(old['partners'], partners)
+                partners = old['partners'][keep].tolist() + partners
+                new = {name: np.concatenate([old[name][keep], new[name]])
+                       for name in new}
+            fileName = self.getFileName(owner)
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(fileName),
+                                           suffix='.npz')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, partners=np.array(partners, dtype=str), **new)
+            os.replace(tmpName, fileName)
+
+    @staticmethod
+    def _group(pairs):
+        """ {owner: [(position in pairs, partner)]}"""
+        groups = {}
+        for n, pair in enumerate(pairs):
+            owner, partner = sorted(pair)
+            groups.setdefault(owner, []).append((n, partner))
+        return groups
+
+    def _read(self, owner):
+        try:
+            with np.load(self.getFileName(owner)) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+
+def linkOrCopy(source, target):
+    """ Make target available with the content of source without copying
+        it when possible: hard link, then symbolic link (e.g. source in
+        another file system), then copy"""
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), target)
+        except OSError:
+            shutil.copyfile(source, target)
+    return target
+
+
+def shrinkNpyFile(fileName, length):
+    """ Keep the first length rows of the array in a .npy file (e.g.
+        created with numpy.lib.format.open_memmap for a maximum number
+        of rows), in place: the shape in the header is rewritten with
+        the same header size and the file is truncated"""
+    with open(fileName, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        dataStart = f.tell()
+        if length > shape[0]:
+            raise ValueError("%s has only %d rows" % (fileName, shape[0]))
+        shape = (length,) + tuple(shape[1:])
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': fortranOrder, 'shape': shape})
+        # magic string, version and header length (2 or 4 bytes)
+        headerStart = 10 if version == (1, 0) else 12
+        size = dataStart - headerStart
+        # the new shape is not longer than the old one
+        f.seek(headerStart)
+        f.write(header.ljust(size - 1).encode('latin1') + b'\n')
+        f.truncate(dataStart + int(np.prod(shape)) * dtype.itemsize)
+
+
+def getTileSize(memoryBudget, bytesPerVoxel=BYTES_PER_VOXEL):
+    """ Number of voxels that can be processed at once without
+        exceeding memoryBudget (in MB)"""
+    return max(1, int(memoryBudget * 1024 ** 2 / bytesPerVoxel))
+
+
+def interpolateTransformedSum(volume, xyz, transforms, chunkSize=CHUNK_SIZE,
+                              deviations=None, dtype=np.float64):
+    """ Trilinear interpolation of volume at the points xyz transformed
+        by each one of the matrices in transforms.
+        volume: 3D array (z, y, x), it may be a numpy.memmap, or a list
+                of them with the same shape (maps on the same grid)
+        xyz: (4, n) points in generalized coordinates (x, y, z, 1)
+        transforms: (K, 4, 4) transformation matrices
+        chunkSize: maximum number of interpolated points (n * K) processed
+                   at once, it controls the size of the temporary arrays
+        deviations: optional (n,) array (list of them if volume is a
+                    list), the sum of the squared deviations of the K
+                    interpolated values from their mean is added to it
+        dtype: floating point type of coordinates, weights and results.
+               With np.float32 memory traffic is halved, see
+               SINGLE_PRECISION_TOLERANCE
+        return the sum of the K interpolated values at each point (n,),
+        a list of sums if volume is a list
+
+        All the transformations are applied with a single matrix product
+        and the indexes and weights of the eight neighbours are computed
+        in buffers that are allocated once and reused for every chunk.
+        With several volumes indexes and weights are computed only once,
+        each extra volume just costs a gather, multiply and add.
+        Points outside the volume get the value of the closest border.
+    """
+    isList = isinstance(volume, (list, tuple))
+    volumes = list(volume) if isList else [volume]
+    if deviations is not None and not isList:
+        deviations = [deviations]
+    transforms = np.asarray(transforms, dtype=dtype)
+    xyz = np.asarray(xyz, dtype=dtype)
+    n = xyz.shape[1]
+    outputs = [np.zeros(n, dtype=dtype) for _ in volumes]
+    K = len(transforms)
+    if K == 0 or n == 0:
+        return outputs if isList else outputs[0]
+    step = max(1, min(n, chunkSize // K))
+    size = step * K
+
+    # rows ordered as x for every transform, y for every transform...
+    # so (transforms @ xyz) becomes (3, K * step) with no copy
+    stacked = transforms[:, :3, :].transpose(1, 0, 2).reshape(3 * K, 4)
+    flats = [v.reshape(-1) for v in volumes]
+    dims = volumes[0].shape[::-1]  # x, y, z
+    strides = (1, dims[0], dims[0] * dims[1])
+
+    # buffers reused by all the chunks
+    coordsBuffer = np.empty(3 * size, dtype=dtype)
+    lowerBuffer = np.empty((3, size), dtype=dtype)
+    upperBuffer = np.empty((3, size), dtype=dtype)
+    index0Buffer = np.empty((3, size), dtype=np.intp)
+    index1Buffer = np.empty((3, size), dtype=np.intp)
+    indexBuffer = np.empty(size, dtype=np.intp)
+    weightBuffer = np.empty(size, dtype=dtype)
+    productBuffer = np.empty(size, dtype=dtype)
+    # one value and one sum buffer per volume
+    valueBuffers = [np.empty(size, dtype=v.dtype) for v in volumes]
+    sumBuffers = [np.empty(size, dtype=dtype) for _ in volumes]
+
+    for first in range(0, n, step):
+        last = min(first + step, n)
+        m = (last - first) * K
+        coords = coordsBuffer[:3 * m].reshape(3 * K, last - first)
+        np.dot(stacked, xyz[:, first:last], out=coords)
+        coords = coords.reshape(3, m)
+
+        # per axis: index of the two neighbours and their weights
+        for axis in range(3):
+            c = coords[axis]
+            lower = lowerBuffer[axis, :m]
+            upper = upperBuffer[axis, :m]
+            index0 = index0Buffer[axis, :m]
+            index1 = index1Buffer[axis, :m]
+            np.clip(c, 0, dims[axis] - 1, out=c)
+            np.floor(c, out=lower)
+            np.copyto(index0, lower, casting='unsafe')
+            np.add(index0, 1, out=index1)
+            np.minimum(index1, dims[axis] - 1, out=index1)
+            index0 *= strides[axis]
+            index1 *= strides[axis]
+            # weights of the upper and lower neighbours
+            np.subtract(c, lower, out=upper)
+            np.subtract(1., upper, out=lower)
+
+        totals = [sumBuffer[:m] for sumBuffer in sumBuffers]
+        for total in totals:
+            total[:] = 0.
+        index = indexBuffer[:m]
+        weight = weightBuffer[:m]
+        product = productBuffer[:m]
+        for cz in range(2):
+            for cy in range(2):
+                for cx in range(2):
+                    ix = (index1Buffer if cx else index0Buffer)[0, :m]
+                    iy = (index1Buffer if cy else index0Buffer)[1, :m]
+                    iz = (index1Buffer if cz else index0Buffer)[2, :m]
+                    wx = (upperBuffer if cx else lowerBuffer)[0, :m]
+                    wy = (upperBuffer if cy else lowerBuffer)[1, :m]
+                    wz = (upperBuffer if cz else lowerBuffer)[2, :m]
+                    np.add(ix, iy, out=index)
+                    index += iz
+                    np.multiply(wx, wy, out=weight)
+                    weight *= wz
+                    # the same neighbours and weights for every volume
+                    for flat, valueBuffer, total in zip(flats, valueBuffers,
+                                                        totals):
+                        value = valueBuffer[:m]
+                        np.take(flat, index, out=value, mode='clip')
+                        np.multiply(weight, value, out=product)
+                        total += product
+        for v, total in enumerate(totals):
+            copies = total.reshape(K, last - first)
+            copiesSum = copies.sum(axis=0)
+            outputs[v][first:last] += copiesSum
+            if deviations is not None:
+                copiesSum /= K
+                copies -= copiesSum
+                np.square(copies, out=copies)
+                deviations[v][first:last] += copies.sum(axis=0)
+    return outputs if isList else outputs[0]
+
+
+class Envelope:
+    """ Voxels closer than radius to any of the points
+        (atoms in pixels, (n, 3) array with x, y, z columns)"""
+    def __init__(self, points, radius):
+        self.points = np.asarray(points, dtype=float)
+        self.radius = radius
+        self._tree = None
+
+    def contains(self, x, y, z):
+        """ return boolean array, True for the voxels x, y, z inside"""
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        distance, _ = self._tree.query(np.column_stack([x, y, z]),
+                                       distance_upper_bound=self.radius)
+        return np.isfinite(distance)
+
+    def __getstate__(self):
+        # the tree is rebuilt by each worker process
+        return {'points': self.points, 'radius': self.radius,
+                '_tree': None}
+
+
+def _getTileCoords(boxStart, boxShape, first, last, envelope=None):
+    """ z, y, x coordinates of the voxels in the tile [first, last)
+        of the box and, if envelope is given, mask of the voxels
+        inside it (None otherwise)"""
+    z, y, x = np.unravel_index(np.arange(first, last), boxShape)
+    z += boxStart[0]
+    y += boxStart[1]
+    x += boxStart[2]
+    if envelope is None:
+        return z, y, x, None
+    inside = envelope.contains(x, y, z)
+    return z[inside], y[inside], x[inside], inside
+
+
+def _averageTile(volumes, boxStart, boxShape, transforms, chunkSize,
+                 envelope, withDeviations, dtype, first, last):
+    """ Sum of the voxel values of the tile [first, last) of the box and
+        of the transformed copies of them, for each one of the volumes.
+        Voxels outside the envelope are skipped.
+        return z, y, x coordinates of the tile voxels, mask of the
+        voxels inside the envelope, the list of sums and, if
+        withDeviations, the list of sums of squared deviations from
+        the mean (None otherwise)"""
+    z, y, x, inside = _getTileCoords(boxStart, boxShape, first, last,
+                                     envelope)
+    xyz = np.vstack([x, y, z, np.ones_like(x)]).astype(dtype)
+    tiles = [volume[z, y, x].astype(dtype) for volume in volumes]
+    deviations = [np.zeros(len(z), dtype=dtype) for _ in volumes] \
+        if withDeviations else None
+    copies = interpolateTransformedSum(volumes, xyz, transforms,
+                                       chunkSize=chunkSize,
+                                       deviations=deviations, dtype=dtype)
+    K = len(transforms)
+    for v, tile in enumerate(tiles):
+        if withDeviations and K:
+            # add the voxel itself (a single value, no deviation) to the
+            # statistics of the K copies, pairwise update of Welford's
+            # method
+            delta = copies[v] / K - tile
+            deviations[v] += delta ** 2 * K / (K + 1.)
+        tile += copies[v]
+    return z, y, x, inside, tiles, deviations
+
+
+class SharedVolumes:
+    """ Volumes stored in shared memory blocks so that the worker
+        processes of iterAveragedTiles use them without copies.
+        Each volume is copied into its block as it is added, the caller
+        should not keep its own copy. It behaves as a list of arrays,
+        call close (or use it as a context manager) to free the blocks
+    """
+    def __init__(self, volumes=()):
+        self.blocks = []
+        self.volumes = []
+        for volume in volumes:
+            self.append(volume)
+
+    def append(self, volume):
+        """ copy volume (an array or a numpy.memmap, read from disk
+            as it is copied) into a new shared memory block"""
+        dtype = volume.dtype.newbyteorder('=')
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(1, volume.nbytes))
+        self.blocks.append(block)
+        self.volumes.append(np.ndarray(volume.shape, dtype=dtype,
+                                       buffer=block.buf))
+        self.volumes[-1][:] = volume
+        return self.volumes[-1]
+
+    def getSpecs(self):
+        """ what _initAveragingWorker needs to attach to the blocks"""
+        return [('shm', block.name, volume.shape, volume.dtype)
+                for block, volume in zip(self.blocks, self.volumes)]
+
+    def close(self):
+        self.volumes = []  # the blocks can not be closed while in use
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def __getitem__(self, index):
+        return self.volumes[index]
+
+    def __iter__(self):
+        return iter(self.volumes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# state of each worker process, set by _initAveragingWorker
+_worker = {}
+
+
+def _initAveragingWorker(volumeSpecs, boxStart, boxShape, transforms,
+                         chunkSize, envelope, withDeviations, dtype):
+    """ Attach the worker to the input volumes, either shared memory
+        blocks created by the parent process or MRC files"""
+    from .convert import mapMrcData
+    volumes = []
+    _worker['blocks'] = []  # keep the blocks alive
+    for volumeSpec in volumeSpecs:
+        if volumeSpec[0] == 'shm':
+            _, name, shape, volumeType = volumeSpec
+            block = shared_memory.SharedMemory(name=name)
+            _worker['blocks'].append(block)
+            volumes.append(np.ndarray(shape, dtype=volumeType,
+                                      buffer=block.buf))
+        else:
+            volumes.append(mapMrcData(volumeSpec[1]))
+    _worker['args'] = (volumes, boxStart, boxShape, transforms, chunkSize,
+                       envelope, withDeviations, dtype)
+
+
+def _averageTileWorker(tileRange):
+    first, last = tileRange
+    _, _, _, inside, tiles, deviations = _averageTile(*_worker['args'],
+                                                      first, last)
+    return first, last, inside, tiles, deviations
+
+
+def iterAveragedTiles(volumes, boxStart, boxShape, transforms, tileSize,
+                      numberOfWorkers=1, mrcFileNames=None, envelope=None,
+                      withDeviations=False, dtype=np.float64):
+    """ Sum of each voxel of the box (start and shape in z, y, x)
+        and its copies given by the transforms, for each one of
+        the volumes (maps with the same shape, e.g. half maps).
+        The box is processed in tiles of tileSize voxels. If
+        numberOfWorkers > 1 the tiles are distributed among a pool of
+        processes. The workers read the input directly from mrcFileNames
+        if given, or from shared memory: volumes may be a SharedVolumes
+        (no copy is made, the map sits once in memory) or a list of arrays
+        that are copied into shared memory. Volumes are never replicated
+        per worker, and each one accumulates the copies of its own tiles.
+        Interpolation indexes and weights are computed once per tile
+        and shared by all the volumes.
+        If an Envelope is given only the voxels inside it are
+        transformed and interpolated.
+        If withDeviations, the sum of squared deviations from the mean
+        (M2 of Welford's algorithm) is computed in the same pass, the
+        variance is M2 / (K + 1)
+        dtype is the floating point type used in the computations
+        yield z, y, x, sums, M2s (or None) for every tile, in order,
+        sums and M2s are lists with an array per volume
+    """
+    nVoxels = int(np.prod(boxShape))
+    tileRanges = [(first, min(first + tileSize, nVoxels))
+                  for first in range(0, nVoxels, tileSize)]
+    transforms = np.asarray(transforms, dtype=dtype)
+
+    if numberOfWorkers <= 1 or len(tileRanges) <= 1:
+        for first, last in tileRanges:
+            z, y, x, _, tiles, deviations = _averageTile(
+                list(volumes), boxStart, boxShape, transforms, tileSize,
+                envelope, withDeviations, dtype, first, last)
+            yield z, y, x, tiles, deviations
+        return
+
+    copied = None  # shared memory copies made here
+    try:
+        if mrcFileNames is not None:
+            volumeSpecs = [('mrc', fn) for fn in mrcFileNames]
+        elif isinstance(volumes, SharedVolumes):
+            volumeSpecs = volumes.getSpecs()
+        else:
+            copied = SharedVolumes(volumes)
+            volumeSpecs = copied.getSpecs()
+        numberOfWorkers = min(numberOfWorkers, len(tileRanges))
+        with ProcessPoolExecutor(
+                max_workers=numberOfWorkers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_initAveragingWorker,
+                initargs=(volumeSpecs, boxStart, boxShape, transforms,
+                          tileSize, envelope, withDeviations,
+                          dtype)) as executor:
+            # only a few tiles are in flight, so the finished ones do not
+            # pile up in memory if they are consumed slower than computed
+            pending = deque()
+            tileRanges = iter(tileRanges)
+            for tileRange in tileRanges:
+                pending.append(executor.submit(_averageTileWorker, tileRange))
+                if len(pending) >= TILES_IN_FLIGHT_PER_WORKER * numberOfWorkers:
+                    break
+            while pending:
+                first, last, inside, tiles, deviations = \
+                    pending.popleft().result()
+                tileRange = next(tileRanges, None)
+                if tileRange is not None:
+                    pending.append(executor.submit(_averageTileWorker,
+                                                   tileRange))
+                z, y, x, _ = _getTileCoords(boxStart, boxShape, first, last)
+                if inside is not None:
+                    z, y, x = z[inside], y[inside], x[inside]
+                yield z, y, x, tiles, deviations
+    finally:
+        if copied is not None:
+            copied.close()
+
+
+def kabsch(fixed, moving):
+    """ Batched least squares superposition (Kabsch algorithm).
+        fixed, moving: arrays (K, N, 3) (or (N, 3) if broadcastable)
+        return matrices (K, 4, 4) and rms (K,) such that
+        fixed ~ matrices[:, :3, :3] @ moving + matrices[:, :3, 3]
+        All the superpositions are solved with a single batched SVD.
+    """
+    fixed = np.asarray(fixed, dtype=float)
+    moving = np.asarray(moving, dtype=float)
+    fixed, moving = np.broadcast_arrays(fixed, moving)
+    if fixed.ndim == 2:
+        fixed, moving = fixed[None], moving[None]
+    n = fixed.shape[1]
+    fixedCenter = fixed.mean(axis=1)
+    movingCenter = moving.mean(axis=1)
+    fixed0 = fixed - fixedCenter[:, None, :]
+    moving0 = moving - movingCenter[:, None, :]
+
+    # covariance matrices (K, 3, 3)
+    covariance = np.einsum('kni,knj->kij', moving0, fixed0)
+    u, s, vt = np.linalg.svd(covariance)
+    # avoid reflections
+    d = np.sign(np.linalg.det(np.matmul(u, vt)))
+    d[d == 0] = 1.
+    s[:, 2] *= d
+    vt[:, 2, :] *= d[:, None]
+    rotation = np.matmul(vt.transpose(0, 2, 1), u.transpose(0, 2, 1))
+
+    matrices = np.tile(np.eye(4), (len(fixed), 1, 1))
+    matrices[:, :3, :3] = rotation
+    matrices[:, :3, 3] = fixedCenter - np.einsum('kij,kj->ki', rotation,
+                                                 movingCenter)
+    squared = ((fixed0 ** 2).sum(axis=(1, 2)) +
+               (moving0 ** 2).sum(axis=(1, 2)) - 2. * s.sum(axis=1))
+    rms = np.sqrt(np.maximum(squared, 0.) / max(n, 1))
+    return matrices, rms
+
+
+def pairwiseRMSD(coords, rows=None, blockSize=256):
+    """ RMSD (no superposition) between every pair of structures.
+        coords: (M, N, 3) coordinates of the N atoms of M structures
+        rows: indexes of the structures compared with all the others
+              (None -> all of them)
+        blockSize: number of rows of the matrix computed at once
+        return (len(rows), M) matrix, (M, M) symmetric if rows is None
+        Uses the Gram identity |a - b|^2 = |a|^2 + |b|^2 - 2 a.b so each
+        block of rows is a single matrix product.
+    """
+    coords = np.asarray(coords, dtype=float)
+    M, N = coords.shape[:2]
+    rows = np.arange(M) if rows is None else np.asarray(rows, dtype=int)
+    # centering on the mean structure does not change the differences
+    # and reduces the cancellation errors of the identity
+    X = (coords - coords.mean(axis=0)).reshape(M, -1)
+    norms = np.einsum('ij,ij->i', X, X)
+    matrix = np.empty((len(rows), M))
+    for first in range(0, len(rows), blockSize):
+        last = min(first + blockSize, len(rows))
+        block = matrix[first:last]
+        np.dot(X[rows[first:last]], X.T, out=block)
+        block *= -2.
+        block += norms[rows[first:last], None]
+        block += norms[None, :]
+        np.maximum(block, 0., out=block)
+    matrix /= max(N, 1)
+    np.sqrt(matrix, out=matrix)
+    matrix[np.arange(len(rows)), rows] = 0.
+    return matrix
+
+
+def residueRMSD(first, second, residueCounts):
+    """ Per residue RMSD (no superposition) of pairs of structures.
+        first, second: (P, N, 3) (or (N, 3)) coordinates of P pairs
+        residueCounts: (R,) number of atoms of each residue, atoms of
+                       a residue are consecutive
+        return (P, R) (or (R,)) array, NaN for residues without atoms
+        The squared deviations of the atoms are added per residue
+        with a single np.add.reduceat.
+    """
+    diff = np.asarray(first, dtype=float) - np.asarray(second, dtype=float)
+    single = diff.ndim == 2
+    if single:
+        diff = diff[None]
+    squared = np.einsum('pni,pni->pn', diff, diff)
+    counts = np.asarray(residueCounts, dtype=int)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    nonEmpty = counts > 0
+    # reduceat does not support empty segments, they are left as NaN
+    sums = np.full((len(squared), len(counts)), np.nan)
+    if nonEmpty.any():
+        sums[:, nonEmpty] = np.add.reduceat(squared, starts[nonEmpty],
+                                            axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.sqrt(sums / counts)
+    return result[0] if single else result
+
+
+def superposedResidueRMSD(first, second, residueCounts):
+    """ Per residue RMSD of pairs of structures after the least squares
+        superposition of second onto first (see kabsch and residueRMSD).
+        first, second: (P, N, 3) (or (N, 3)) coordinates of P pairs
+        return (P, R) (or (R,)) array, NaN for residues without atoms
+        All the pairs are superposed with a single batched SVD.
+    """
+    first, second = np.broadcast_arrays(np.asarray(first, dtype=float),
+                                        np.asarray(second, dtype=float))
+    single = first.ndim == 2
+    if single:
+        first, second = first[None], second[None]
+    matrices, _ = kabsch(first, second)
+    moved = (np.matmul(second, matrices[:, :3, :3].transpose(0, 2, 1)) +
+             matrices[:, None, :3, 3])
+    result = residueRMSD(first, moved, residueCounts)
+    return result[0] if single else result
+
+
+def overallRMSD(residueRMSDs, residueCounts):
+    """ Overall RMSD from the per residue RMSDs computed by residueRMSD
+        (residues without atoms, NaN, are ignored)
+        residueRMSDs: (..., R) array
+        return (...) array
+    """
+    counts = np.asarray(residueCounts, dtype=float)
+    squared = np.nansum(np.square(residueRMSDs) * counts, axis=-1)
+    return np.sqrt(squared / max(counts.sum(), 1.))
+
+
+def populationCorrection(n, population=None):
+    """ Finite population correction of the standard error of the mean
+        of n samples drawn without replacement from population items
+        (None -> infinite population, no correction)"""
+    if population is None:
+        return 1.
+    n = np.asarray(n, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n >= population, 0.,
+                        np.sqrt(np.maximum(population - n, 0.) /
+                                max(population - 1, 1)))
+
+
+def confidenceInterval(values, axis=0, z=1.96, population=None):
+    """ Half width of the (95% by default) confidence interval of the
+        mean of the samples values along axis, NaN are ignored.
+        population: number of items the samples were drawn from without
+        replacement (None -> infinite)"""
+    values = np.asarray(values, dtype=float)
+    n = np.sum(~np.isnan(values), axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return z * np.nanstd(values, axis=axis, ddof=1) / np.sqrt(n) * \
+            populationCorrection(n, population)
+
+
+class RunningStatistics:
+    """ Mean, standard deviation and maximum of each column of a stream
+        of samples that is processed by blocks of rows. Memory does not
+        depend on the number of samples. Blocks are merged with the
+        pairwise update of Welford's algorithm (Chan et al.). Without
+        samples the mean and standard deviation are NaN"""
+    def __init__(self, size):
+        self.count = 0
+        self.mean = np.full(size, np.nan)
+        self.m2 = np.zeros(size)  # sum of squared deviations from the mean
+        self.max = np.full(size, -np.inf)
+
+    def update(self, samples):
+        """ add the rows of samples (n, size)"""
+        samples = np.asarray(samples, dtype=float).reshape(-1, len(self.mean))
+        n = len(samples)
+        if n == 0:
+            return
+        blockMean = samples.mean(axis=0)
+        blockM2 = np.square(samples - blockMean).sum(axis=0)
+        if self.count == 0:
+            self.mean = blockMean
+            self.m2 = blockM2
+            self.count = n
+            self.max = samples.max(axis=0)
+            return
+        total = self.count + n
+        delta = blockMean - self.mean
+        self.mean += delta * n / total
+        self.m2 += blockM2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.max = np.maximum(self.max, samples.max(axis=0))
+
+    @property
+    def std(self):
+        """ sample standard deviation (n - 1 degrees of freedom)"""
+        if self.count == 0:
+            return np.full_like(self.mean, np.nan)
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    def confidenceInterval(self, z=1.96, population=None):
+        """ half width of the (95% by default) confidence interval of
+            the mean. population: number of items the samples were drawn
+            from without replacement (None -> infinite)"""
+        return z * self.std / np.sqrt(max(self.count, 1)) * \
+            populationCorrection(self.count, population)